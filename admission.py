@@ -0,0 +1,187 @@
+"""
+Ограничение числа одновременных генераций отчета.
+
+Сборка документа занимает много памяти, поэтому одновременно идет не больше max_inflight
+генераций на всю машину: слот - это блокировка файла slot-N.lock в общем каталоге, ее держит
+процесс-воркер и она снимается сама, если воркер упал. Остальные запросы ждут в очереди воркера
+по порядку прихода; первый в очереди воркер держит queue.lock, пока не получит слот, так что
+освободившийся слот не перехватывают раз за разом запросы одного воркера. Очередь ограничена,
+и у одного пользователя не больше per_client запросов (в очереди и в работе) на воркер.
+Лишние запросы сразу получают отказ с Retry-After.
+
+Каждая генерация воркера, идущая или ожидающая, занимает два потока gunicorn (gthread): сам
+запрос /generate и поток событий /generate_progress, который страница держит открытым до конца
+генерации. Поэтому генераций в работе и в очереди на воркер не больше (WEB_THREADS - 1) // 2,
+один поток остается остальным запросам: иначе потоки кончатся раньше, чем заполнится очередь,
+и лишние запросы будут копиться в backlog gunicorn без отказа.
+"""
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: слоты только в пределах процесса
+    fcntl = None
+
+
+GENERATE_MAX_INFLIGHT = int(os.getenv('GENERATE_MAX_INFLIGHT', str(max(1, (os.cpu_count() or 2) // 2))))
+WEB_THREADS = int(os.getenv('WEB_THREADS', '8'))  # потоков на воркер, как в serve.py
+THREADS_PER_GENERATE = 2  # запрос /generate и поток /generate_progress
+# генераций на воркер (в работе и в очереди), на которые хватает потоков
+GENERATE_THREADS_BUDGET = max(1, (WEB_THREADS - 1) // THREADS_PER_GENERATE)
+GENERATE_QUEUE = int(os.getenv('GENERATE_QUEUE', str(max(1, GENERATE_THREADS_BUDGET - 1))))  # ожидающих на воркер
+GENERATE_PER_CLIENT = int(os.getenv('GENERATE_PER_CLIENT', '2'))
+GENERATE_QUEUE_TIMEOUT = int(os.getenv('GENERATE_QUEUE_TIMEOUT', '60'))  # секунды
+
+SLOT_POLL = 0.1  # как часто первый в очереди проверяет освободившиеся слоты, секунды
+
+
+class Rejected(Exception):
+    """Запрос не принят: status - код ответа (429 или 503), retry_after - через сколько секунд повторить"""
+
+    def __init__(self, status, retry_after, detail):
+        super().__init__(detail)
+        self.status = status
+        self.retry_after = retry_after
+        self.detail = detail
+
+
+class AdmissionController:
+    def __init__(self, slots_dir, max_inflight=GENERATE_MAX_INFLIGHT, max_queue=GENERATE_QUEUE,
+                 per_client=GENERATE_PER_CLIENT, queue_timeout=GENERATE_QUEUE_TIMEOUT):
+        self.slots_dir = str(slots_dir)
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        # (генерации в работе + в очереди) * THREADS_PER_GENERATE < WEB_THREADS
+        self.max_active = min(max_inflight + max_queue, GENERATE_THREADS_BUDGET)
+        if max_inflight + max_queue > GENERATE_THREADS_BUDGET:
+            print(f"GENERATE_MAX_INFLIGHT={max_inflight} + GENERATE_QUEUE={max_queue} генераций не помещаются "
+                  f"в WEB_THREADS={WEB_THREADS} потоков (по {THREADS_PER_GENERATE} на генерацию): на воркер "
+                  f"принимается не больше {self.max_active}, иначе перегрузка не отсекается")
+        self.per_client = per_client
+        self.queue_timeout = queue_timeout
+        self._condition = threading.Condition()
+        self._queue = deque()  # билеты ожидающих запросов по порядку прихода
+        self._clients = {}  # client_id -> запросов в очереди и в работе
+        self._running = 0  # генераций этого воркера в занятых слотах
+        self._free_local = list(range(max_inflight))  # слоты без блокировки файлов
+        self._turnstile = None  # открытый queue.lock, пока первый в очереди ждет слот
+        self._render_time = 10.0  # средняя длительность генерации для Retry-After, секунды
+        os.makedirs(self.slots_dir, exist_ok=True)
+
+    def retry_after(self, position=None) -> int:
+        position = len(self._queue) if position is None else position
+        return max(1, math.ceil(self._render_time * (position + 1) / self.max_inflight))
+
+    def _try_slot(self):
+        """Свободный слот: (номер, открытый файл блокировки или None) либо None"""
+        if fcntl is None:
+            return (self._free_local.pop(), None) if self._free_local else None
+        if self._turnstile is None:
+            self._turnstile = self._lock_file('queue.lock')
+            if self._turnstile is None:  # первым ждет запрос другого воркера
+                return None
+        for number in range(self.max_inflight):
+            lock_file = self._lock_file(f"slot-{number}.lock")
+            if lock_file is not None:
+                self._leave_turnstile()
+                return number, lock_file
+        return None
+
+    def _lock_file(self, name):
+        """Открытый файл с захваченной блокировкой или None, если она занята"""
+        lock_file = open(os.path.join(self.slots_dir, name), 'a+')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_file
+        except OSError:  # занята другим воркером или потоком
+            lock_file.close()
+            return None
+
+    def _leave_turnstile(self):
+        if self._turnstile is not None:
+            fcntl.flock(self._turnstile, fcntl.LOCK_UN)
+            self._turnstile.close()
+            self._turnstile = None
+
+    def _release_slot(self, slot):
+        number, lock_file = slot
+        if lock_file is None:
+            self._free_local.append(number)
+        else:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def acquire(self, client_id):
+        """Ждет свободный слот; при переполнении очереди или превышении лимита бросает Rejected"""
+        ticket = object()
+        with self._condition:
+            if self._clients.get(client_id, 0) >= self.per_client:
+                raise Rejected(429, self.retry_after(),
+                               "Слишком много одновременных генераций, дождитесь предыдущих документов")
+            if len(self._queue) >= self.max_queue or len(self._queue) + self._running >= self.max_active:
+                raise Rejected(503, self.retry_after(), "Сервер перегружен, повторите попытку позже")
+            self._clients[client_id] = self._clients.get(client_id, 0) + 1
+            self._queue.append(ticket)
+            deadline = time.monotonic() + self.queue_timeout
+            try:
+                while True:
+                    if self._queue[0] is ticket:
+                        slot = self._try_slot()
+                        if slot is not None:
+                            self._queue.popleft()
+                            self._running += 1
+                            self._condition.notify_all()
+                            return slot
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise Rejected(503, self.retry_after(self._queue.index(ticket)),
+                                       "Сервер перегружен, повторите попытку позже")
+                    # слот другого воркера освобождается без уведомления, поэтому ожидание с таймаутом
+                    self._condition.wait(min(SLOT_POLL, remaining))
+            except BaseException:
+                if self._queue and self._queue[0] is ticket:
+                    self._leave_turnstile()  # следующий в очереди начнет ждать заново
+                if ticket in self._queue:
+                    self._queue.remove(ticket)
+                    self._condition.notify_all()
+                self._leave(client_id)
+                raise
+
+    def release(self, client_id, slot, render_time=None):
+        with self._condition:
+            self._release_slot(slot)
+            self._running -= 1
+            self._leave(client_id)
+            if render_time is not None:
+                self._render_time = 0.8 * self._render_time + 0.2 * render_time
+            self._condition.notify_all()
+
+    @contextmanager
+    def admit(self, client_id):
+        """with admit(client_id): генерация в занятом слоте"""
+        slot = self.acquire(client_id)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(client_id, slot, time.monotonic() - started)
+
+    def _leave(self, client_id):
+        count = self._clients.get(client_id, 0) - 1
+        if count > 0:
+            self._clients[client_id] = count
+        else:
+            self._clients.pop(client_id, None)
+
+    def after_fork(self):
+        """В новом воркере (gunicorn post_fork): своя очередь и блокировка"""
+        self._condition = threading.Condition()
+        self._queue = deque()
+        self._clients = {}
+        self._running = 0
+        self._turnstile = None
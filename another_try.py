@@ -1,7 +1,14 @@
+import hashlib
 import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from copy import deepcopy
 
 from docx.oxml import parse_xml
-from flask import Flask, request, send_file, render_template, jsonify, has_request_context
+from flask import Flask, g, request, send_file, send_from_directory, render_template, jsonify, has_request_context
 
 from pathlib import Path
 from datetime import datetime
@@ -9,17 +16,25 @@ from dateutil.relativedelta import relativedelta
 import io
 
 from docx import Document
+from docx.table import Table
 
 import pandas as pd
 
-from db import DatabaseManager
+from db import CachedDatabaseManager
 
 import logging
 import sys
 
 from urllib.parse import quote
 
+import admission
 import application_processing
+import file_store
+import instruments
+import manifest
+import progress
+import snapshot
+import static_assets
 
 
 class ContextualLogger:
@@ -80,8 +95,73 @@ app = Flask(
 )
 
 logger.info("initializing db")
-db = DatabaseManager()
-logger.info("db is ready")
+db = CachedDatabaseManager()
+db.start_warmup()  # подключение в фоне: эндпоинты без БД работают сразу
+logger.info("db warm-up started")
+
+# локальный снимок справочных данных: генерация продолжает работать, пока БД недоступна
+reference_snapshot = snapshot.SnapshotReader()
+
+
+@app.before_request
+def open_db_session():
+    db.begin_request()
+
+
+@app.teardown_request
+def close_db_session(exc):
+    db.end_request()
+
+
+def is_valid_client_id(client_id):
+    return len(client_id) == 32 and all(char in '0123456789abcdef' for char in client_id)
+
+
+def get_client_address():
+    """Адрес клиента; за прокси - последний адрес, добавленный своими прокси в X-Forwarded-For"""
+    if WEB_TRUSTED_PROXIES:
+        forwarded = [address.strip() for address in request.headers.get('X-Forwarded-For', '').split(',')
+                     if address.strip()]
+        if len(forwarded) >= WEB_TRUSTED_PROXIES:
+            return forwarded[-WEB_TRUSTED_PROXIES]
+    return request.remote_addr or 'unknown'
+
+
+def get_limit_key():
+    """
+    Ключ пользователя для лимита генераций: cookie client_id, а без нее - адрес клиента,
+    иначе скрипт без cookie получал бы новый идентификатор на каждый запрос
+    """
+    client_id = request.cookies.get(CLIENT_COOKIE, '')
+    if is_valid_client_id(client_id):
+        return client_id
+    return 'addr:' + get_client_address()
+
+
+def get_client_id():
+    """Идентификатор пользователя из cookie; новому пользователю выдается в ответе"""
+    client_id = request.cookies.get(CLIENT_COOKIE, '')
+    if not is_valid_client_id(client_id):
+        if 'new_client_id' not in g:
+            g.new_client_id = uuid.uuid4().hex
+        client_id = g.new_client_id
+    return client_id
+
+
+def report_stage(stage):
+    """Отмечает завершенный этап генерации: длительность в лог и событие для страницы"""
+    report_progress = g.get('progress') if has_request_context() else None
+    if report_progress is not None:
+        duration = report_progress.stage(stage)
+        logger.info(f"STAGE {stage}: {duration:.3f}s")
+
+
+@app.after_request
+def set_client_cookie(response):
+    if 'new_client_id' in g:
+        response.set_cookie(CLIENT_COOKIE, g.new_client_id, max_age=CLIENT_COOKIE_MAX_AGE,
+                            httponly=True, samesite='Lax')
+    return response
 
 BASE_DIR = Path(__file__).parent
 UPLOAD_DIR = BASE_DIR / "uploads"
@@ -90,16 +170,75 @@ STATIC_DIR = BASE_DIR / "static"
 TEMPLATE_PATH = BASE_DIR / "templates/template_file.docx"
 DATA_DIR = BASE_DIR / "data"
 
+# брать сотрудников и приборы из БД при генерации; со встроенной SQLite включено по умолчанию
+USE_DB = os.getenv("USE_DB", "1" if db.is_embedded else "0") == "1"
+if USE_DB:  # снимок читается только при генерации из БД, без нее выгружать его незачем
+    snapshot.start_periodic_export(db)
+
+# загрузка графика: предельный размер и размер куска при записи на диск
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(20 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# запрос больше предела отклоняется с 413 до разбора multipart; предел свой у каждого маршрута
+FORM_FIELDS_SIZE = 1024 * 1024  # поля формы сверх файлов
+GRAF_REQUEST_SIZE = MAX_UPLOAD_SIZE + FORM_FIELDS_SIZE
+# /generate и /preview: график, фотографии (до 10 МБ каждая, как на странице) и поля формы
+MAX_IMAGE_SIZE = 10 * 1024 * 1024
+MAX_GENERATE_IMAGES = int(os.getenv("MAX_GENERATE_IMAGES", "20"))
+GENERATE_REQUEST_SIZE = MAX_UPLOAD_SIZE + MAX_GENERATE_IMAGES * MAX_IMAGE_SIZE + FORM_FIELDS_SIZE
+# пользователь (для своих загруженных файлов) определяется по cookie
+CLIENT_COOKIE = "client_id"
+CLIENT_COOKIE_MAX_AGE = 365 * 24 * 3600
+# сколько обратных прокси (nginx) стоит перед приложением: адрес клиента берется из X-Forwarded-For
+WEB_TRUSTED_PROXIES = int(os.getenv("WEB_TRUSTED_PROXIES", "0"))
+
+DOCX_MIMETYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+# начиная с такого количества секций строки приложений пишутся потоком при сохранении
+APPENDIX_STREAM_THRESHOLD = int(os.getenv("APPENDIX_STREAM_THRESHOLD", "300"))
+
 UPLOAD_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
 STATIC_DIR.mkdir(exist_ok=True)
 
+# готовые отчеты: хранятся по хэшу содержимого, старые удаляются в фоне
+output_store = file_store.FileStore(OUTPUT_DIR)
+output_store.start_cleaner()
+
+# загруженные графики: файлы по хэшу, у каждого пользователя свой текущий файл в журнале
+upload_store = file_store.FileStore(UPLOAD_DIR)
+upload_store.start_cleaner()
+files_manifest = manifest.Manifest(DATA_DIR / "manifest.db")
+
+# ход генерации для страницы: этапы пишутся в общий для всех воркеров файл
+progress_log = progress.ProgressLog(DATA_DIR / "progress.db")
+
+# не больше GENERATE_MAX_INFLIGHT генераций на всю машину, остальные ждут в ограниченной очереди
+generate_admission = admission.AdmissionController(DATA_DIR / "render_slots")
+
+# статика в памяти со сжатыми вариантами; в шаблонах ссылки через asset_url('css/...')
+assets = static_assets.StaticAssets(STATIC_DIR).build()
+app.jinja_env.globals['asset_url'] = assets.url
+
+# отрисованная index.html: пересобирается только при изменении файла шаблона
+index_page = {'key': None, 'body': None}
+index_page_lock = threading.Lock()
+
 months = {
     1: "января", 2: "февраля", 3: "марта", 4: "апреля",
     5: "мая", 6: "июня", 7: "июля", 8: "августа",
     9: "сентября", 10: "октября", 11: "ноября", 12: "декабря"
 }
 
+# имена таблиц шаблона по старым индексам doc.tables, если в шаблоне нет якорей
+# ({{table:имя}} в первой ячейке, закладка или подпись)
+TEMPLATE_TABLES = {
+    "instruments": 3,
+    "pril_12_zms": 38,
+    "pril_12_not_zms": 39,
+    "pril_13_zms": 42,
+    "pril_13_not_zms": 43,
+}
+
 pipline_types = {
     "Выкидная линия": "ВЛ",
     "Водовод высокого давления": "ВВД",
@@ -114,10 +253,17 @@ class WordTemplateProcessor:
     def __init__(self, template_path: str):
         self.doc = Document(template_path)
         self.replacements = {}
+        self.repeat_blocks = application_processing.get_repeat_blocks(template_path, self.doc)
+        self.tables = application_processing.get_table_registry(template_path, self.doc,
+                                                                TEMPLATE_TABLES).bind(self.doc)
 
     def set_replacements(self, data: dict):
         self.replacements = data
 
+    def render_repeat_blocks(self, collections: dict):
+        """Размножает строки таблиц с {{#repeat имя}} по коллекциям"""
+        application_processing.render_repeat_blocks(self.doc, self.repeat_blocks, collections)
+
     def process_headers_footers(self):
         """Обработка всех колонтитулов в документе"""
         print("Обработка верхних колонтитулов (headers)")
@@ -319,10 +465,28 @@ class WordTemplateProcessor:
         else:
             print(f"Таблица с индексом {table_index} не найдена")
 
+    def get_table(self, name: str) -> Table:
+        """Таблица шаблона по имени из реестра"""
+        return Table(self.tables[name], self.doc._body)
+
+    def replace_table(self, name: str, new_table_xml):
+        """Замена таблицы по имени из реестра"""
+        old_table_element = self.tables[name]
+        if isinstance(new_table_xml, str):
+            new_table_element = parse_xml(new_table_xml)
+        else:
+            new_table_element = new_table_xml._tbl
+        old_table_element.getparent().replace(old_table_element, new_table_element)
+        self.tables[name] = new_table_element
+        print(f"Таблица {name} успешно заменена")
+
     def get_cell_info_from_index_table(self, table_index: int, cell_pos: tuple[int, int]):
         table = self.doc.tables[table_index]
         return table.cell(*cell_pos).text
 
+    def get_cell_info_from_table(self, name: str, cell_pos: tuple[int, int]):
+        return self.get_table(name).cell(*cell_pos).text
+
     def get_bytes(self):
         """Возвращает документ в виде bytes"""
         output = io.BytesIO()
@@ -331,449 +495,710 @@ class WordTemplateProcessor:
         return output.getvalue()
 
 
+def get_index_page():
+    key = os.path.getmtime(Path(app.root_path) / app.template_folder / "index.html")
+    with index_page_lock:
+        if index_page['key'] != key:
+            html = render_template("index.html")
+            index_page['body'] = static_assets.CompressedBody(html.encode('utf-8'), 'text/html; charset=utf-8')
+            index_page['key'] = key
+        return index_page['body']
+
+
 @app.route("/", methods=["GET"])
 def read_root():
     logger.info("IN GET")
-    return render_template("index.html")
+    return static_assets.make_response_for(get_index_page(), request, app.response_class,
+                                           static_assets.CACHE_REVALIDATE)
 
 
-@app.route("/generate", methods=["POST"])
-def generate_document():
-    """Генерация документа с заменой плейсхолдеров"""
-    try:
-        logger.info("GENERATING")
-
-        processor = WordTemplateProcessor(str(TEMPLATE_PATH))
-        logger.info("CREATED FILE")
-
-        grafic = request.files.get("graf_file")
-        report_number = request.form.get("TO_number")
-
-        pipline_type = request.form.get("pipline_type")
-        pipline_name = request.form.get("pipline_name")
-
-        temperature = request.form.get("temperature")
-        pressure_work = request.form.get("pressure_work")
-        pressure_project = request.form.get("pressure_project")
-        insulation = request.form.get('insulation')
-        logger.info("INSULATION: " + str(insulation))
-        anticor = request.form.get("anticor")
-        inside_cover = request.form.get("inside_cover")
-        welding = request.form.get("welding")
-        project_documentation = request.form.get("project_documentation")
-        installation_company = request.form.get("installation_company")
-
-        pipline_category = request.form.get("pipeline_category")
-        passport_date = datetime.fromisoformat(request.form.get("passport_date")).strftime("%d.%m.%Y")
-        working_environment = request.form.get("working_environment")
-
-        sections_manual_data = json.loads(request.form.get('sections_data'))
-        logger.info("GOT VALUES")
-
-        # template_file вы сейчас игнорируете и всегда берете TEMPLATE_PATH
-        # Если нужно использовать загруженный шаблон, можно сохранить его и
-        # подставлять путь вместо TEMPLATE_PATH.
-
-        curr_date = datetime.now().strftime("%d.%m.%Y")
-        str_curr_date = f"{datetime.now().day} {months[datetime.now().month]} {datetime.now().year} года"
-        curr_year = str(datetime.now().year)
-        year_short = curr_year[-2:]
-
-        logger.info("CURR_YEAR: " + str(curr_year))
-        # --------------------------------------------------------
-        # EXCEL
-
-        import time
-
-        start = time.time()
-
-        # GRAFIC TABLE
-        df = pd.read_excel(grafic, nrows=100, dtype=str, engine='openpyxl')
-
-        csv = df.to_csv(sep=';').split('\n')
-        csv = [i.split(';') for i in csv]
-
-        row_index = 0
-
-        logger.info("GOT REPORT_NUMBER: " + str(report_number))
-        for row in range(len(csv)):
-            if report_number in csv[row]:
-                row_index = row
-
-        end = time.time()
-
-        logger.info("Time = " + str(end - start))
-
-        # excel = win32com.client.Dispatch("Excel.Application")
-        # excel.Visible = False  # Скрыть Excel
-        #
-        # wb = excel.Workbooks.Open(r'worl_files/grafic.xlsx')
-        # ws = wb.Worksheets(1)  # Первый лист
-
-        deposit = csv[row_index][3]
-        workshop = csv[row_index][4]
-        inventory_number = csv[row_index][5]
-        # pipline_name = csv[row_index][7]
-        length_of_pipline = csv[row_index][11]
-        length_of_area = csv[row_index][12]
-        wall_diam = csv[row_index][9]
-        wall_thic = str(float(csv[row_index][10])).replace('.', ',')
-        wall_params = f"{wall_diam}x{wall_thic}"
-        year_of_commissioning = datetime.fromisoformat(csv[row_index][13]).year
-        year_of_using = datetime.now().year - year_of_commissioning
-        diagnostic_date = datetime.fromisoformat(csv[row_index][19]).strftime("%d.%m.%Y")
-        next_diagnostic_deadline = (datetime.fromisoformat(csv[row_index][19]) + relativedelta(years=4)).strftime("%d.%m.%Y")
-        steel = csv[row_index][14]
-
-        leader_surname = csv[row_index][21]
-
-        # HZ NOMERNAYA TABLE
-        # number_table = request.files.get("report_table_file")
-
-        # enter_lay = pd.read_excel(number_table, sheet_name="Ввод данных", nrows=20, dtype=str, engine='openpyxl')
-        # logger.info("FILE READED")
-        # enter_lay_csv = enter_lay.to_csv(sep=';').split('\n', )
-        # logger.info(enter_lay_csv)
-        # enter_lay_csv = [i.split(';') for i in enter_lay_csv]
-
-        # full_pipline_name = enter_lay_csv[0][2]
-        # ----------------------------------------------------------
-        # DATABASE
+def serve_static(filename):
+    """Замена стандартного /static: сжатые варианты, ETag, долгий кэш для ссылок с хэшем"""
+    asset = assets.get(filename)
+    if asset is None:
+        return send_from_directory(STATIC_DIR, filename)
+    if request.args.get('v') == asset.version:
+        cache_control = static_assets.CACHE_IMMUTABLE
+    else:
+        cache_control = static_assets.CACHE_REVALIDATE
+    return static_assets.make_response_for(asset, request, app.response_class, cache_control)
 
-        logger.info("LEADER SURNAME: " + str(leader_surname))
 
+app.view_functions['static'] = serve_static
 
-        BD_AVIABLE = False
-        if BD_AVIABLE:
-            leader = None  # Employer class
-            employees = db.get_all_employees()
-            for employer in employees:
-                logger.info("db surname: " + str(employer.surname))
-                print(employer.surname.strip() == leader_surname.strip())
-                if employer.surname.strip() == leader_surname.strip():
-                    leader = employer
-                    break
-            else:
-                logger.info("Leader NOT found")
-                raise "Leader not found"
-
-            logger.info("Leader found")
-            team_number = leader.team_number
-            leader_full = leader.surname + " " + leader.name + " " + leader.lastname
-            leader_short = leader.name[0] + ". " + leader.lastname[0] + ". " + leader.surname
-            leader_position = leader.position
-            leader_license = leader.license
-
-            # team_members = [] если вдруг команда будет состоять больше чем из 2 человек
-            worker = None  # Employer class
-            for employer in employees:
-                if employer.team_number == team_number and employer.id != leader.id:
-                    worker = employer
-                    break
-
-            worker_full = worker.surname + " " + worker.name + " " + worker.lastname
-            worker_short = worker.name[0] + ". " + worker.lastname[0] + ". " + worker.surname
-            worker_position = worker.position
-            worker_license = worker.license
-            logger.info("ALL DATA GOT")
-            instrument_table = leader.instrument_table
-            logger.info("L_F: " + str(leader_full))
-            logger.info("L_S: " + str(leader_short))
-            logger.info("L_Pos: " + str(leader_position))
-            logger.info("L_Lic: " + str(leader_license))
-
-            logger.info("W_F: " + str(worker_full))
-            logger.info("W_S: " + str(worker_short))
-            logger.info("W_Pos: " + str(worker_position))
-            logger.info("W_Lic: " + str(worker_license))
-            # word_tables = db.get_all_tables()
-            # for word_table in word_tables:
-            #     if word_table['prilojenie'] == 'prilojenie 12_2':
-            #         # TOD сделать таблицу из yaml, потом добавить в него данные и заменить
-            # ----------------------------------------------------------
-            # Instrument table replacing
-
-            processor.replace_table_by_index(3, instrument_table)
-
-            logger.info("TABLE REPLACED")
 
-        else:
-            logger.warning("BD inactive")
-            leader_full = 'NONE'
-            leader_short = 'NONE'
-            leader_position = 'NONE'
-            leader_license = 'NONE'
+# разобранные графики по хэшу файла: одна и та же форма присылает график при каждой генерации
+GRAF_ROWS_CACHE_SIZE = 16
+graf_rows_cache = OrderedDict()
+graf_rows_lock = threading.Lock()
 
-            worker_full = 'NONE'
-            worker_short = 'NONE'
-            worker_position = 'NONE'
-            worker_license = 'NONE'
 
-        # ----------------------------------------------------------
-        # applications tables generation
-        sections = {'not ZMS': [], 'ZMS': []}
-        for section in sections_manual_data:
+def read_graf_rows(grafic) -> list[list[str]]:
+    """Строки графика (как csv через ';'), разбор один раз на содержимое файла"""
+    data = grafic.read()
+    key = hashlib.sha256(data).hexdigest()
+    with graf_rows_lock:
+        if key in graf_rows_cache:
+            graf_rows_cache.move_to_end(key)
+            return graf_rows_cache[key]
+
+    df = pd.read_excel(io.BytesIO(data), nrows=100, dtype=str, engine='openpyxl')
+    csv = df.to_csv(sep=';').split('\n')
+    csv = [i.split(';') for i in csv]
+
+    with graf_rows_lock:
+        graf_rows_cache[key] = csv
+        while len(graf_rows_cache) > GRAF_ROWS_CACHE_SIZE:
+            graf_rows_cache.popitem(last=False)
+    return csv
+
+
+def get_instrument_layout(processor=None):
+    """Раскладка таблицы приборов шаблона; без кэша шаблон открывается один раз"""
+    def template_table():
+        return (processor or WordTemplateProcessor(str(TEMPLATE_PATH))).get_table('instruments')
+
+    return instruments.get_layout(TEMPLATE_PATH, template_table)
+
+
+def build_sections(sections_manual_data, steel, errors=None) -> dict:
+    """
+    Секции из формы по типам: {'ZMS': [...], 'not ZMS': [...]}.
+    Если передан список errors, ошибки секций записываются в него, а секция пропускается
+    """
+    sections = {'not ZMS': [], 'ZMS': []}
+    for section in sections_manual_data:
+        try:
             obj = application_processing.Section(f"Секция {section['number']}",
                                                  application_processing.SectionType(section['type']),
                                                  section['picket'],
                                                  section['diameter'], float(section['nominalThickness']), steel,
                                                  float(section['minThickness']))
             obj.set_values()
-            if section['type'] == 'ЗМС':
-                sections['ZMS'].append(obj)
-            else:
-                sections['not ZMS'].append(obj)
+            if errors is not None:
+                # те же данные, что пойдут в приложения 12 и 13 (в том числе нормы отбраковки)
+                application_processing.pril_12_2_row_texts(obj, application_processing.load_otbrak_data())
+                application_processing.pril_13_row_texts(obj)
+        except Exception as e:
+            if errors is None:
+                raise
+            errors.append(f"Секция {section.get('number')}: {e}")
+            continue
+        if section['type'] == 'ЗМС':
+            sections['ZMS'].append(obj)
+        else:
+            sections['not ZMS'].append(obj)
+    return sections
+
+
+def resolve_report(form, grafic, errors=None, processor=None, persist=True) -> dict:
+    """
+    Данные отчета без работы с документом: строка графика, бригада из БД, строки приложений,
+    секции и итоговый словарь замен.
+    Возвращает {'replacements', 'sections', 'sections_count', 'team_instruments',
+    'instrument_table', 'output_filename', 'snapshot_age'}.
+    Если передан список errors, ненайденный руководитель и ошибки секций записываются в него.
+    persist=False - ничего не сохранять в БД (предпросмотр)
+    """
+    report_number = form.get("TO_number")
+
+    pipline_type = form.get("pipline_type")
+    pipline_name = form.get("pipline_name")
+
+    temperature = form.get("temperature")
+    pressure_work = form.get("pressure_work")
+    pressure_project = form.get("pressure_project")
+    insulation = form.get('insulation')
+    logger.info("INSULATION: " + str(insulation))
+    anticor = form.get("anticor")
+    inside_cover = form.get("inside_cover")
+    welding = form.get("welding")
+    project_documentation = form.get("project_documentation")
+    installation_company = form.get("installation_company")
+
+    pipline_category = form.get("pipeline_category")
+    passport_date = datetime.fromisoformat(form.get("passport_date")).strftime("%d.%m.%Y")
+    working_environment = form.get("working_environment")
+
+    sections_manual_data = json.loads(form.get('sections_data'))
+    logger.info("GOT VALUES")
+    report_stage('values')
+
+    curr_date = datetime.now().strftime("%d.%m.%Y")
+    str_curr_date = f"{datetime.now().day} {months[datetime.now().month]} {datetime.now().year} года"
+    curr_year = str(datetime.now().year)
+    year_short = curr_year[-2:]
+
+    logger.info("CURR_YEAR: " + str(curr_year))
+    # --------------------------------------------------------
+    # EXCEL
+
+    start = time.time()
+
+    # GRAFIC TABLE
+    csv = read_graf_rows(grafic)
+
+    row_index = 0
+
+    logger.info("GOT REPORT_NUMBER: " + str(report_number))
+    for row in range(len(csv)):
+        if report_number in csv[row]:
+            row_index = row
+
+    end = time.time()
+
+    logger.info("Time = " + str(end - start))
+    report_stage('graf')
+
+    deposit = csv[row_index][3]
+    workshop = csv[row_index][4]
+    inventory_number = csv[row_index][5]
+    # pipline_name = csv[row_index][7]
+    length_of_pipline = csv[row_index][11]
+    length_of_area = csv[row_index][12]
+    wall_diam = csv[row_index][9]
+    wall_thic = str(float(csv[row_index][10])).replace('.', ',')
+    wall_params = f"{wall_diam}x{wall_thic}"
+    year_of_commissioning = datetime.fromisoformat(csv[row_index][13]).year
+    year_of_using = datetime.now().year - year_of_commissioning
+    diagnostic_date = datetime.fromisoformat(csv[row_index][19]).strftime("%d.%m.%Y")
+    next_diagnostic_deadline = (datetime.fromisoformat(csv[row_index][19]) + relativedelta(years=4)).strftime("%d.%m.%Y")
+    steel = csv[row_index][14]
+
+    leader_surname = csv[row_index][21]
+
+    # ----------------------------------------------------------
+    # DATABASE
+
+    logger.info("LEADER SURNAME: " + str(leader_surname))
+
+    # раскладка таблицы приборов шаблона: считается один раз на файл шаблона
+    layout_cells, layout_key = get_instrument_layout(processor)
+    prilojenie = None
+    team_instruments = None
+    instrument_table = None
+
+    BD_AVIABLE = USE_DB and db.is_ready()
+    source = db
+    snapshot_age = None
+    if USE_DB and not BD_AVIABLE:
+        logger.warning("BD is not ready yet: " + str(db.last_error))
+        if reference_snapshot.is_available():
+            source = reference_snapshot
+            snapshot_age = reference_snapshot.age()
+            BD_AVIABLE = True
+            logger.info(f"Using reference snapshot, age {snapshot_age:.0f}s")
+    leader = None
+    if BD_AVIABLE:
+        leader, team = source.get_team_by_leader_surname(leader_surname)  # Employer class, [Employer class]
+        if leader is None and source is db and not db.is_ready() and reference_snapshot.is_available():
+            # БД пропала уже после старта: запрос не выполнился, те же данные берутся из снимка
+            source = reference_snapshot
+            snapshot_age = reference_snapshot.age()
+            logger.warning(f"BD connection lost ({db.last_error}), using reference snapshot, age {snapshot_age:.0f}s")
+            leader, team = source.get_team_by_leader_surname(leader_surname)
+        if leader is None:
+            logger.info("Leader NOT found")
+            if errors is None:
+                raise Exception("Leader not found")
+            errors.append(f"Руководитель {leader_surname} не найден")
+
+    if leader is not None:
+        logger.info("Leader found")
+        team_number = leader.team_number
+        leader_full = leader.surname + " " + leader.name + " " + leader.lastname
+        leader_short = leader.name[0] + ". " + leader.lastname[0] + ". " + leader.surname
+        leader_position = leader.position
+        leader_license = leader.license
+
+        # team - все члены бригады, если вдруг команда будет состоять больше чем из 2 человек
+        worker = team[0] if team else None  # Employer class
+
+        worker_full = worker.surname + " " + worker.name + " " + worker.lastname
+        worker_short = worker.name[0] + ". " + worker.lastname[0] + ". " + worker.surname
+        worker_position = worker.position
+        worker_license = worker.license
+        logger.info("ALL DATA GOT")
+        instrument_table = leader.instrument_table
+        logger.info("L_F: " + str(leader_full))
+        logger.info("L_S: " + str(leader_short))
+        logger.info("L_Pos: " + str(leader_position))
+        logger.info("L_Lic: " + str(leader_license))
+
+        logger.info("W_F: " + str(worker_full))
+        logger.info("W_S: " + str(worker_short))
+        logger.info("W_Pos: " + str(worker_position))
+        logger.info("W_Lic: " + str(worker_license))
+        # ----------------------------------------------------------
+        # Instrument table
+
+        team_instruments = source.get_team_instruments(team_number)
+        if not team_instruments and source is db and not db.is_ready() and reference_snapshot.is_available():
+            source = reference_snapshot
+            snapshot_age = reference_snapshot.age()
+            logger.warning(f"BD connection lost ({db.last_error}), using reference snapshot, age {snapshot_age:.0f}s")
+            team_instruments = source.get_team_instruments(team_number)
+        if team_instruments:
+            # строки приложений бригады сохранены заранее, пересчет только после смены приборов
+            prilojenie = source.get_team_prilojenie(team_number, layout_key)
+            if prilojenie is None:
+                prilojenie = instruments.build_prilojenie(
+                    instruments.instrument_cells(team_instruments, layout_cells))
+                if persist:
+                    source.save_team_prilojenie(team_number, layout_key, prilojenie)
+        elif instrument_table is not None:
+            # бригада еще не перенесена в таблицу instruments: строки из ее XML-таблицы
+            prilojenie = instruments.build_prilojenie(
+                instruments.table_cells(Table(parse_xml(instrument_table), None)))
 
-        application_processing.add_row_pril_12_2(sections['ZMS'], processor.doc.tables[38])
-        print('table 38 replaced')
-        application_processing.add_row_pril_12_2(sections['not ZMS'], processor.doc.tables[39])
-        print('table 39 replaced')
-        application_processing.add_row_pril_13(sections['ZMS'], processor.doc.tables[42])
-        print('table 42 replaced')
-        application_processing.add_row_pril_13(sections['not ZMS'], processor.doc.tables[43])
-        print('table 43 replaced')
+    else:
+        logger.warning("BD inactive")
+        leader_full = 'NONE'
+        leader_short = 'NONE'
+        leader_position = 'NONE'
+        leader_license = 'NONE'
+
+        worker_full = 'NONE'
+        worker_short = 'NONE'
+        worker_position = 'NONE'
+        worker_license = 'NONE'
+    report_stage('team')
+
+    if prilojenie is None:
+        # таблица приборов остается как в шаблоне
+        prilojenie = instruments.build_prilojenie(layout_cells)
+
+    # ----------------------------------------------------------
+    # applications tables
+    sections = build_sections(sections_manual_data, steel, errors)
+    report_stage('sections')
+
+    safety_working_chance = {
+        'IV': '0,95',
+        'III': '0,85',
+        'II': '0,75',
+    }
 
-        """
-        TABLES
-        5 - 21
-        6 - 24
-        
-        9 - 27
-        
-        12 - 38 | 39
-        13 - 42 | 43
-        
-        """
-
-        logger.info("APPLICATION TABLES GENERATED")
-        # ----------------------------------------------------------
-        row_data = []
-        for i in range(5):
-            row_data.append(processor.get_cell_info_from_index_table(3, (52, 2 + i)).strip())
-        prilojenie_5 = [f"{row_data[0]} {row_data[1]},\n зав. № {row_data[2]}", f"№ {row_data[4]} до {row_data[3]}"]
-
-        row_data = []
-        for i in range(5):
-            row_data.append(processor.get_cell_info_from_index_table(3, (51, 2 + i)).strip())
-        prilojenie_6 = [
-            f"{row_data[0]} {row_data[1]}, зав. № {row_data[2]}, {processor.get_cell_info_from_index_table(3, (56, 2)).strip()}"
-            f"\n(2 шт.), {processor.get_cell_info_from_index_table(3, (56, 6)).lower().strip()}.",
-            f"№ {row_data[4]} до {row_data[3]}"]
-
-        row_data = []
-        row_data.append([processor.get_cell_info_from_index_table(3, (2, 1)).strip()])
-        print(row_data)
-        for j in range(2, 11):
-            row_data.append([])
-            print(row_data)
-            for i in range(4):
-                row_data[j - 1].append(processor.get_cell_info_from_index_table(3, (j, 2 + i)).strip())
-
-        prilojenie_10 = [f"{row_data.pop(0)[0]}:\n"]
-
-        print(row_data)
-        for row_instr in row_data:
-            print("PROLOJ:", prilojenie_10[0])
-            print("ROW_INSTR:", row_instr)
-            prilojenie_10[0] += f" {row_instr[0]} {row_instr[1]} зав. № {row_instr[2]};"
-
-        prilojenie_10.append("")
-        prilojenie_10[1] += (f"№{processor.get_cell_info_from_index_table(3, (2, 6)).strip()} до "
-                             f"{processor.get_cell_info_from_index_table(3, (2, 5)).strip()};")
-
-        for row_instr in (11, 12, 13, 46):
-            prilojenie_10[0] += (f" {processor.get_cell_info_from_index_table(3, (row_instr, 2)).strip()} "
-                                 f"{processor.get_cell_info_from_index_table(3, (row_instr, 3)).strip()} "
-                                 f"зав. № {processor.get_cell_info_from_index_table(3, (row_instr, 4)).strip()};")
-
-            prilojenie_10[1] += (f" № {processor.get_cell_info_from_index_table(3, (row_instr, 6)).strip()} до "
-                                 f"{processor.get_cell_info_from_index_table(3, (row_instr, 5)).strip()};")
-
-        prilojenie_10.append("")
-        for row_instr in (15, 16, 17, 18):
-            prilojenie_10[2] += (f" {processor.get_cell_info_from_index_table(3, (row_instr, 3)).strip()}"
-                                 f" зав. № {processor.get_cell_info_from_index_table(3, (row_instr, 4)).strip()}"
-                                 f" свид. {processor.get_cell_info_from_index_table(3, (row_instr, 6)).strip()}"
-                                 f" до {processor.get_cell_info_from_index_table(3, (row_instr, 5)).strip()}\n")
-        prilojenie_10[2] = prilojenie_10[2].strip()
-
-        for_insert_text = prilojenie_10[0].split(' ')
-        index_linear = for_insert_text.index('Линейка')
-        for_insert_text[index_linear + 2] = 'Л-300'  # заменяем 'мм' на 'Л-300'
-        for_insert_text[index_linear + 3] = '(' + for_insert_text[index_linear + 3] + ')'
-        prilojenie_10[0] = ' '.join(for_insert_text)
-
-        row_data = []
-        for i in range(5):
-            row_data.append(processor.get_cell_info_from_index_table(3, (20, 2 + i)).strip())
-        prilojenie_11 = [f"{row_data[0]} {row_data[1]},\n заводской № {row_data[2]}",
-                         f"№ {row_data[4]} до {row_data[3]}", ""]
-
-        for row_instr in (28, 29, 31, 32, 33, 34, 35, 36, 37, 38, 39):
-            prilojenie_11[2] += (f"{processor.get_cell_info_from_index_table(3, (row_instr, 3)).strip()}"
-                                 f" зав. № {processor.get_cell_info_from_index_table(3, (row_instr, 4)).strip()}"
-                                 f" свид. № {processor.get_cell_info_from_index_table(3, (row_instr, 6)).strip()}"
-                                 f" до {processor.get_cell_info_from_index_table(3, (row_instr, 5)).strip()};\n")
-        prilojenie_11[2] = prilojenie_11[2].strip()
-
-        row_data = []
-        for i in range(5):
-            row_data.append(processor.get_cell_info_from_index_table(3, (19, 2 + i)).strip())
-        prilojenie_12 = [f"{row_data[0]} {row_data[1]} зав. № {row_data[2]}",
-                         f"№ {row_data[4]} до {row_data[3]}", ""]
-        row_data = []
-        for i in range(4):
-            row_data.append(processor.get_cell_info_from_index_table(3, (30, 3 + i)).strip())
-        prilojenie_12[2] = f"{row_data[0]} зав. № {row_data[1]} свид. № {row_data[3]} до {row_data[2]};"
-
-        row_data = []
-        for i in range(5):
-            row_data.append(processor.get_cell_info_from_index_table(3, (21, 2 + i)).strip())
-        prilojenie_13 = [f"{row_data[0]} {row_data[1]} № {row_data[2]}",
-                         f"№ {row_data[4]} до {row_data[3]}", ""]
-        row_data = []
-        for i in range(5):
-            row_data.append(processor.get_cell_info_from_index_table(3, (22, 2 + i)).strip())
-        prilojenie_13[2] = f"{row_data[0]} {row_data[1]} № {row_data[2]}\n№ {row_data[4]} до {row_data[3]}"
-
-        prilojenie_14 = (f"{processor.get_cell_info_from_index_table(3, (47, 2)).strip()}"
-                         f" {processor.get_cell_info_from_index_table(3, (47, 3)).strip()}"
-                         f" зав. №{processor.get_cell_info_from_index_table(3, (47, 4)).strip()}")
-
-        print("---PRILOJENIYA---")
-        print("---5---")
-        print(prilojenie_5)
-        print("---6---")
-        print(prilojenie_6)
-        print("---10---")
-        print(prilojenie_10)
-
-        additions_rows = [(52, 2), (51, 2), None, (2 - 9, 1), (20, 2)]
-
-        additions = {
-            'control_instruments': [],
-            'verification_certificate': [],
-            'control_according': []
-        }
-
-        safety_working_chance = {
-            'IV': '0,95',
-            'III': '0,85',
-            'II': '0,75',
-        }
-
-        safety_working_chance_procent = {
-            'IV': '95,00',
-            'III': '85,00',
-            'II': '75,00',
-        }
+    safety_working_chance_procent = {
+        'IV': '95,00',
+        'III': '85,00',
+        'II': '75,00',
+    }
 
-        # ----------------------------------------------------------
-        replacements = {
-            '{{curr_year}}': curr_year,
-            '{{report_number}}': report_number,
-            '{{rep_num}}': report_number,
-            '{{year_short}}': year_short,
-
-            '{{pipline_name}}': pipline_name,  # временно
-            '{{pipline_type}}': pipline_type,
-            '{{full_pipline_name}}': f'{pipline_type} «{pipline_name}»',
-
-            '{{inventory_number}}': inventory_number,
-            '{{deposit}}': deposit,
-            '{{workshop}}': workshop,
-            '{{diagnostic_date}}': diagnostic_date,
-            '{{next_diagnostic_deadline}}': next_diagnostic_deadline,
-            '{{passport_date}}': passport_date,
-            '{{working_environment}}': working_environment,
-            '{{pipline_category}}': pipline_category,
-            '{{safety_working_chance}}': safety_working_chance[pipline_category],
-            '{{safety_working_chance_procent}}': safety_working_chance_procent[pipline_category],
-            '{{curr_date}}': curr_date,
-            '{{str_curr_date}}': str_curr_date,  # день сделать двойным числом всегда
-            '{{length_of_area}}': length_of_area,
-            '{{length_of_pipline}}': length_of_pipline,
-            '{{steel_grade}}': steel,
-            '{{wall_params}}': wall_params,
-            '{{wall_diam}}': wall_diam,
-            '{{wall_thic}}': wall_thic,
-            '{{year_of_commissioning}}': year_of_commissioning,  # эксплуатации
-            '{{years_of_using}}': year_of_using,
-
-            '{{leader_full}}': leader_full,  # Иванов Иван Иванович
-            '{{leader_short}}': leader_short,  # Иванов И. И.
-            '{{leader_position}}': leader_position,
-            '{{leader_license}}': leader_license,
-
-            '{{worker_full}}': worker_full,
-            '{{worker_short}}': worker_short,
-            '{{worker_position}}': worker_position,
-            '{{worker_license}}': worker_license,
-
-            '{{temperature}}': temperature,
-            '{{pressure_work}}': pressure_work,
-            '{{pressure_project}}': pressure_project,
-            '{{insulation}}': insulation,
-            '{{anticor}}': anticor,
-            '{{inside_cover}}': inside_cover,
-            '{{welding}}': welding,
-            '{{project_documentation}}': project_documentation,
-            '{{installation_company}}': installation_company,
-
-            '{{control_instruments_5}}': prilojenie_5[0],
-            '{{control_instruments_6}}': prilojenie_6[0],
-            '{{control_instruments_10}}': prilojenie_10[0],
-            '{{control_instruments_11}}': prilojenie_11[0],
-            '{{control_instruments_12}}': prilojenie_12[0],
-            '{{control_instruments_13}}': prilojenie_13[0],
-            '{{control_instruments_14}}': prilojenie_14,
-            '{{verification_certificate_5}}': prilojenie_5[1],
-            '{{verification_certificate_6}}': prilojenie_6[1],
-            '{{verification_certificate_10}}': prilojenie_10[1],
-            '{{verification_certificate_11}}': prilojenie_11[1],
-            '{{verification_certificate_12}}': prilojenie_12[1],
-            '{{verification_certificate_13}}': prilojenie_13[1],
-
-            '{{standard_sample_10}}': prilojenie_10[2],
-            '{{standard_sample_12}}': prilojenie_12[2],
-            '{{SOP_11}}': prilojenie_11[2],
-            '{{hardness_measures_13}}': prilojenie_13[2]
-        }
-
-        processor.set_replacements(replacements)
-        logger.info("SET REPLACEMENTS")
-        processor.process_document()
-        logger.info("PROCESS")
-
-        # output_filename = f'{filename}.docx'
-        output_filename = f'{report_number}_{pipline_types[pipline_type]}_{pipline_name}.docx'
-        logger.info("FILE NAME: " + str(output_filename))
-
-        output_path = OUTPUT_DIR / output_filename
-        processor.doc.save(output_path)
+    # ----------------------------------------------------------
+    replacements = {
+        '{{curr_year}}': curr_year,
+        '{{report_number}}': report_number,
+        '{{rep_num}}': report_number,
+        '{{year_short}}': year_short,
+
+        '{{pipline_name}}': pipline_name,  # временно
+        '{{pipline_type}}': pipline_type,
+        '{{full_pipline_name}}': f'{pipline_type} «{pipline_name}»',
+
+        '{{inventory_number}}': inventory_number,
+        '{{deposit}}': deposit,
+        '{{workshop}}': workshop,
+        '{{diagnostic_date}}': diagnostic_date,
+        '{{next_diagnostic_deadline}}': next_diagnostic_deadline,
+        '{{passport_date}}': passport_date,
+        '{{working_environment}}': working_environment,
+        '{{pipline_category}}': pipline_category,
+        '{{safety_working_chance}}': safety_working_chance[pipline_category],
+        '{{safety_working_chance_procent}}': safety_working_chance_procent[pipline_category],
+        '{{curr_date}}': curr_date,
+        '{{str_curr_date}}': str_curr_date,  # день сделать двойным числом всегда
+        '{{length_of_area}}': length_of_area,
+        '{{length_of_pipline}}': length_of_pipline,
+        '{{steel_grade}}': steel,
+        '{{wall_params}}': wall_params,
+        '{{wall_diam}}': wall_diam,
+        '{{wall_thic}}': wall_thic,
+        '{{year_of_commissioning}}': year_of_commissioning,  # эксплуатации
+        '{{years_of_using}}': year_of_using,
+
+        '{{leader_full}}': leader_full,  # Иванов Иван Иванович
+        '{{leader_short}}': leader_short,  # Иванов И. И.
+        '{{leader_position}}': leader_position,
+        '{{leader_license}}': leader_license,
+
+        '{{worker_full}}': worker_full,
+        '{{worker_short}}': worker_short,
+        '{{worker_position}}': worker_position,
+        '{{worker_license}}': worker_license,
+
+        '{{temperature}}': temperature,
+        '{{pressure_work}}': pressure_work,
+        '{{pressure_project}}': pressure_project,
+        '{{insulation}}': insulation,
+        '{{anticor}}': anticor,
+        '{{inside_cover}}': inside_cover,
+        '{{welding}}': welding,
+        '{{project_documentation}}': project_documentation,
+        '{{installation_company}}': installation_company,
+    }
+    replacements.update(prilojenie)
+
+    return {
+        'replacements': replacements,
+        'sections': sections,
+        'sections_count': len(sections_manual_data),
+        'team_instruments': team_instruments,
+        'instrument_table': instrument_table,
+        'output_filename': f'{report_number}_{pipline_types[pipline_type]}_{pipline_name}.docx',
+        'snapshot_age': snapshot_age,
+        'sections_data': sections_manual_data,
+        'steel': steel,
+    }
 
-        return send_file(
-            output_path,
-            as_attachment=True,
-            download_name=quote(output_filename),
-            mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-        )
+
+# таблицы, которые можно перестроить по отдельности, и входные данные, от которых они зависят
+INCREMENTAL_TABLES = {
+    "instruments": "instruments",
+    "pril_12_zms": "ZMS",
+    "pril_12_not_zms": "not ZMS",
+    "pril_13_zms": "ZMS",
+    "pril_13_not_zms": "not ZMS",
+}
+
+# сколько последних документов держать в памяти воркера для повторной генерации и как долго:
+# каждый сеанс - целый документ с копиями таблиц шаблона, а воркеров (2·CPU+1), поэтому немного
+RENDER_SESSIONS_MAX = int(os.getenv("RENDER_SESSIONS_MAX", "2"))
+RENDER_SESSION_TTL = int(os.getenv("RENDER_SESSION_TTL", "600"))  # без повторных генераций, секунды
+RENDER_SESSION_MAX_AGE = int(os.getenv("RENDER_SESSION_MAX_AGE", "3600"))  # с создания, секунды
+
+
+class RenderSession:
+    """
+    Последний отрисованный документ сеанса редактирования (report_id из формы).
+
+    При первой генерации каждый плейсхолдер выносится в свой run и запоминается карта
+    {плейсхолдер: [w:r]} отдельно по документу и по таблицам из INCREMENTAL_TABLES.
+    При следующей генерации меняются только run изменившихся значений, а таблицы
+    перестраиваются из копии шаблона, только если изменились их входные данные
+    (приборы бригады или секции своего типа).
+    """
+
+    def __init__(self, processor: WordTemplateProcessor):
+        self.processor = processor
+        self.template_mtime = os.path.getmtime(TEMPLATE_PATH)
+        self.template_tables = {name: deepcopy(processor.tables[name]) for name in INCREMENTAL_TABLES}
+        self.inputs = {}
+        self.sections = {'ZMS': [], 'not ZMS': []}
+        self.slots = {}  # область ('document' или имя таблицы) -> {плейсхолдер: [w:r]}
+        self.values = {}
+        self.lock = threading.Lock()
+        self.created_at = time.monotonic()
+        self.used_at = self.created_at
+
+    @staticmethod
+    def report_inputs(report) -> dict:
+        if report['team_instruments']:
+            instruments_key = json.dumps([[i.slot, i.kind, i.model, i.serial, i.certificate,
+                                           str(i.valid_until), i.valid_until_raw]
+                                          for i in report['team_instruments']], ensure_ascii=False)
+        else:
+            instruments_key = report['instrument_table']
+        inputs = {'instruments': instruments_key}
+        for kind in ('ZMS', 'not ZMS'):
+            data = [section for section in report['sections_data'] if (section['type'] == 'ЗМС') == (kind == 'ZMS')]
+            inputs[kind] = json.dumps([report['steel'], data], ensure_ascii=False, sort_keys=True)
+        return inputs
+
+    def can_update(self, report) -> bool:
+        if not self.slots or os.path.getmtime(TEMPLATE_PATH) != self.template_mtime:
+            return False
+        inputs = self.report_inputs(report)
+        # блоки {{#repeat}} зависят от всех секций и по отдельности не перестраиваются
+        return not self.processor.repeat_blocks or all(
+            inputs[kind] == self.inputs.get(kind) for kind in ('ZMS', 'not ZMS'))
+
+    def _render_table(self, name, report, restore):
+        processor = self.processor
+        if restore:
+            processor.replace_table(name, Table(deepcopy(self.template_tables[name]), processor.doc._body))
+        if name == 'instruments':
+            if report['team_instruments']:
+                instruments.fill_instrument_table(processor.get_table(name), report['team_instruments'])
+            elif report['instrument_table'] is not None:
+                processor.replace_table(name, report['instrument_table'])
+        elif name.startswith('pril_12'):
+            application_processing.add_row_pril_12_2(self.sections[INCREMENTAL_TABLES[name]], processor.get_table(name))
+        else:
+            application_processing.add_row_pril_13(self.sections[INCREMENTAL_TABLES[name]], processor.get_table(name))
+        self.slots[name] = application_processing.isolate_placeholders(processor.tables[name])
+        self._apply(self.slots[name], self.values)
+
+    @staticmethod
+    def _apply(slots, values):
+        for placeholder, runs in slots.items():
+            if placeholder in values:
+                for r in runs:
+                    application_processing.set_run_text(r, values[placeholder])
+
+    def render(self, report) -> str:
+        """Обновляет документ по данным отчета; возвращает 'full' или 'incremental'"""
+        self.used_at = time.monotonic()
+        first = not self.slots
+        inputs = self.report_inputs(report)
+        values = {key: str(value) for key, value in report['replacements'].items()}
+        changed_values = {key: value for key, value in values.items() if self.values.get(key) != value}
+        self.values = values
+
+        for kind in ('ZMS', 'not ZMS'):
+            if first or inputs[kind] != self.inputs.get(kind):
+                self.sections[kind] = report['sections'][kind]
+        changed_tables = [name for name, source in INCREMENTAL_TABLES.items()
+                          if first or inputs[source] != self.inputs.get(source)]
+        self.inputs = inputs
+
+        for name in changed_tables:
+            self._render_table(name, report, restore=not first)
+
+        if first:
+            self.processor.render_repeat_blocks({
+                'sections': self.sections['ZMS'] + self.sections['not ZMS'],
+                'sections_zms': self.sections['ZMS'],
+                'sections_not_zms': self.sections['not ZMS'],
+            })
+            skip_tables = set(self.processor.tables[name] for name in INCREMENTAL_TABLES)
+            self.slots['document'] = {}
+            for part in self.processor.doc.part.package.iter_parts():
+                element = getattr(part, '_element', None)
+                if element is None:
+                    continue
+                for placeholder, runs in application_processing.isolate_placeholders(element, skip_tables).items():
+                    self.slots['document'].setdefault(placeholder, []).extend(runs)
+            self._apply(self.slots['document'], values)
+            return 'full'
+
+        for region, slots in self.slots.items():
+            if region not in changed_tables:
+                self._apply(slots, changed_values)
+        logger.info(f"INCREMENTAL RENDER: values {len(changed_values)}, tables {changed_tables}")
+        return 'incremental'
+
+
+render_sessions = OrderedDict()
+render_sessions_lock = threading.Lock()
+
+
+def get_render_session(report_id, report):
+    """
+    Сеанс для report_id этого пользователя: существующий, если его документ можно обновить, иначе новый.
+    Ключ - (client_id, report_id), так что чужой документ по известному report_id не достается
+    """
+    key = (get_client_id(), report_id)
+    with render_sessions_lock:
+        now = time.monotonic()
+        for expired in [expired for expired, session in render_sessions.items()
+                        if now - session.used_at > RENDER_SESSION_TTL
+                        or now - session.created_at > RENDER_SESSION_MAX_AGE]:
+            del render_sessions[expired]
+        session = render_sessions.get(key)
+    if session is not None and session.can_update(report):
+        with render_sessions_lock:
+            render_sessions.move_to_end(key)
+        return session
+    session = RenderSession(WordTemplateProcessor(str(TEMPLATE_PATH)))
+    with render_sessions_lock:
+        render_sessions[key] = session
+        while len(render_sessions) > RENDER_SESSIONS_MAX:
+            render_sessions.popitem(last=False)
+    return session
+
+
+REPORT_ID_CHARS = set('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_')
+
+
+@app.route("/generate", methods=["POST"])
+def generate_document():
+    """Генерация документа с заменой плейсхолдеров"""
+    request.max_content_length = GENERATE_REQUEST_SIZE
+    progress_id = request.form.get("progress_id") or ''
+    if progress.is_valid_id(progress_id):
+        g.progress = progress_log.begin(progress_id)
+    else:
+        g.progress = progress.Progress(None, None)
+    try:
+        # тяжелая часть (график, сборка документа) - только в свободном слоте
+        with generate_admission.admit(get_limit_key()):
+            report_stage('admitted')
+            response = build_report_response()
+        g.progress.finish()
+        return response
+    except admission.Rejected as e:
+        logger.warning(f"GENERATE REJECTED ({e.status}): {e.detail}")
+        g.progress.finish(e)
+        return {"detail": e.detail}, e.status, {'Retry-After': str(e.retry_after)}
     except Exception as e:
         logger.info(f"Ошибка сервера: {str(e)}")
+        g.progress.finish(e)
         return {"detail": f"Ошибка сервера: {str(e)}"}, 500
 
 
-@app.route("/process_graf_file", methods=["POST"])
-def process_graf_file():
-    logger.info("PROCESSING FILE")
-    file = request.files.get("graf_file")
+def build_report_response():
+    """Собирает отчет по данным формы и возвращает ответ со скачиванием"""
+    logger.info("GENERATING")
+
+    report = resolve_report(request.form, request.files.get("graf_file"))
+    output_filename = report['output_filename']
+    logger.info("FILE NAME: " + str(output_filename))
+
+    output_store.reserve()
+    output_path = output_store.temp_path('.docx')
+
+    report_id = request.form.get("report_id") or ''
+    render_mode = None
+    if (report_id and len(report_id) <= 64 and set(report_id) <= REPORT_ID_CHARS
+            and report['sections_count'] < APPENDIX_STREAM_THRESHOLD):
+        # сеанс редактирования: обновляются только изменившиеся поля и таблицы
+        session = get_render_session(report_id, report)
+        report_stage('template')
+        with session.lock:
+            render_mode = session.render(report)
+            report_stage(render_mode)
+            session.processor.doc.save(output_path)
+    else:
+        render_document(report, output_path)
+    output_path = output_store.put(output_path)
+    report_stage('saved')
+
+    response = send_download(output_path, quote(output_filename), output_store.content_hash(output_path),
+                             mimetype=DOCX_MIMETYPE)
+    # по этому адресу отчет можно докачать (Range) или скачать повторно
+    response.headers['Content-Location'] = (f"/download_report/{os.path.basename(output_path)}"
+                                            f"?name={quote(output_filename)}")
+    if render_mode is not None:
+        response.headers['X-Render-Mode'] = render_mode
+    if report['snapshot_age'] is not None:
+        response.headers['X-Reference-Snapshot-Age'] = str(int(report['snapshot_age']))
+    return response
+
+
+@app.route("/generate_progress/<progress_id>")
+def generate_progress(progress_id):
+    """
+    Ход генерации с таким progress_id (Server-Sent Events): событие на каждый этап
+    {seq, stage, elapsed, duration, detail} до этапа done или error
+    """
+    if not progress.is_valid_id(progress_id):
+        return {"detail": "Некорректный идентификатор"}, 400
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    after_seq = int(last_event_id) if last_event_id.isdigit() else 0
+    response = app.response_class(progress_log.stream(progress_id, after_seq), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # nginx не буферизует поток
+    return response
+
+
+def render_document(report, output_path):
+    """Полная сборка документа из шаблона"""
+    processor = WordTemplateProcessor(str(TEMPLATE_PATH))
+    logger.info("CREATED FILE")
+    report_stage('template')
+
+    # ----------------------------------------------------------
+    # Instrument table replacing
+    if report['team_instruments']:
+        instruments.fill_instrument_table(processor.get_table('instruments'), report['team_instruments'])
+        logger.info("TABLE REPLACED")
+    elif report['instrument_table'] is not None:
+        # бригада еще не перенесена в таблицу instruments
+        processor.replace_table('instruments', report['instrument_table'])
+        logger.info("TABLE REPLACED")
+    report_stage('instruments')
+
+    # ----------------------------------------------------------
+    # applications tables generation
+    # приложения 12/13 не на {{#repeat}}: многострочные секции и потоковая запись (см. RepeatRowBlock)
+    sections = report['sections']
+    appendix_writer = None
+    if report['sections_count'] >= APPENDIX_STREAM_THRESHOLD:
+        logger.info("STREAMING APPENDIX ROWS")
+        appendix_writer = application_processing.AppendixStreamWriter()
+        application_processing.stream_row_pril_12_2(sections['ZMS'], processor.get_table('pril_12_zms'), appendix_writer)
+        application_processing.stream_row_pril_12_2(sections['not ZMS'], processor.get_table('pril_12_not_zms'), appendix_writer)
+        application_processing.stream_row_pril_13(sections['ZMS'], processor.get_table('pril_13_zms'), appendix_writer)
+        application_processing.stream_row_pril_13(sections['not ZMS'], processor.get_table('pril_13_not_zms'), appendix_writer)
+    else:
+        application_processing.add_row_pril_12_2(sections['ZMS'], processor.get_table('pril_12_zms'))
+        print('table 38 replaced')
+        application_processing.add_row_pril_12_2(sections['not ZMS'], processor.get_table('pril_12_not_zms'))
+        print('table 39 replaced')
+        application_processing.add_row_pril_13(sections['ZMS'], processor.get_table('pril_13_zms'))
+        print('table 42 replaced')
+        application_processing.add_row_pril_13(sections['not ZMS'], processor.get_table('pril_13_not_zms'))
+        print('table 43 replaced')
 
-    file.save("data/graf.xlsx")  # ?если файл не подходящего формата, то надо его удалить?
-    # создает файл, даже если его по сути нет
-    with open("data/date_manager.txt", "w+") as manager:  # может лучше сделать csv
-        manager.write(f"graf.xlsx;{file.filename}\n")  # _TODO сейчас вроде перезаписывается весь файл
+    processor.render_repeat_blocks({
+        'sections': sections['ZMS'] + sections['not ZMS'],
+        'sections_zms': sections['ZMS'],
+        'sections_not_zms': sections['not ZMS'],
+    })
+
+    """
+    TABLES
+    5 - 21
+    6 - 24
+    
+    9 - 27
+    
+    12 - 38 | 39
+    13 - 42 | 43
+    
+    """
+
+    logger.info("APPLICATION TABLES GENERATED")
+    report_stage('appendix')
+    # ----------------------------------------------------------
+    processor.set_replacements(report['replacements'])
+    logger.info("SET REPLACEMENTS")
+    processor.process_document()
+    logger.info("PROCESS")
+    report_stage('replacements')
+
+    if appendix_writer is not None:
+        appendix_writer.save(processor.doc, output_path)
+    else:
+        processor.doc.save(output_path)
 
-    df = pd.read_excel(file, nrows=100, dtype=str, engine='openpyxl')
+
+@app.route("/preview", methods=["POST"])
+def preview_document():
+    """
+    Проверка формы без сборки документа: те же данные, что и у /generate, возвращаются
+    словарем замен вместе с плейсхолдерами шаблона, для которых нет значения
+    """
+    request.max_content_length = GENERATE_REQUEST_SIZE
+    start = time.time()
+    errors = []
+    try:
+        report = resolve_report(request.form, request.files.get("graf_file"), errors, persist=False)
+    except Exception as e:
+        logger.info(f"Ошибка предпросмотра: {str(e)}")
+        return {"success": False, "errors": errors + [str(e)]}, 422
+
+    replacements = report['replacements']
+    unresolved = sorted(
+        placeholder for placeholder in application_processing.get_template_placeholders(TEMPLATE_PATH)
+        if placeholder not in replacements)
+    unresolved += sorted(key for key, value in replacements.items() if value is None)
+    sections = report['sections']
+    return {
+        "success": not errors and not unresolved,
+        "replacements": {key: value if value is None else str(value) for key, value in replacements.items()},
+        "unresolved": unresolved,
+        "errors": errors,
+        "sections": {"ZMS": len(sections['ZMS']), "not ZMS": len(sections['not ZMS'])},
+        "output_filename": report['output_filename'],
+        "time": round(time.time() - start, 4),
+    }
+
+
+def parse_graf_options(path):
+    """Номера ТО из графика (столбец 'ТО №'), None если формат файла неизвестен"""
+    df = pd.read_excel(path, nrows=100, dtype=str, engine='openpyxl')
 
     csv = df.to_csv(sep=';').split('\n')
     csv = [i.split(';') for i in csv]
@@ -786,14 +1211,97 @@ def process_graf_file():
             col = csv[i].index('ТО №')
             break
     else:
-        return {
-            "success": False,
-            "error": "Неизвестный формат файла"
-        }, 500
+        return None
 
     logger.info("ROW: " + str(row) + " COL: " + str(col))
 
-    options = [csv[i_r][col] for i_r in range(row, len(csv)) if (len(csv[i_r]) > 2 and csv[i_r][col] != '')]
+    return [csv[i_r][col] for i_r in range(row, len(csv)) if (len(csv[i_r]) > 2 and csv[i_r][col] != '')]
+
+
+def spool_upload(file, path):
+    """
+    Пишет загруженный файл на диск кусками за один проход, считая sha256; возвращает хэш.
+    Размер запроса уже ограничен request.max_content_length до разбора формы
+    """
+    digest = hashlib.sha256()
+    with open(path, 'wb') as out:
+        for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            out.write(chunk)
+    return digest.hexdigest()
+
+
+@app.errorhandler(413)
+def request_too_large(e):
+    if request.endpoint == 'process_graf_file':
+        message = f"Файл больше {MAX_UPLOAD_SIZE // (1024 * 1024)} МБ"
+    else:
+        message = (f"Слишком большой запрос: не больше {MAX_GENERATE_IMAGES} фотографий "
+                   f"по {MAX_IMAGE_SIZE // (1024 * 1024)} МБ")
+    return {"success": False, "error": message, "detail": message}, 413
+
+
+def send_download(path, download_name, content_hash, mimetype=None):
+    """
+    Отдача файла с сильным ETag по хэшу содержимого: Range/If-Range для докачки
+    и 304 при повторном скачивании того же файла
+    """
+    response = send_file(
+        path,
+        as_attachment=True,
+        download_name=download_name,
+        mimetype=mimetype,
+        etag=content_hash or True,  # без хэша - ETag Flask по времени и размеру
+        conditional=True,
+    )
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@app.route("/download_report/<report_id>", methods=["GET"])
+def download_report(report_id):
+    """Повторное скачивание или докачка отчета, созданного /generate"""
+    path = output_store.get(report_id)
+    if path is None:
+        return {"detail": "Отчет не найден"}, 404
+    download_name = request.args.get('name') or report_id
+    return send_download(path, quote(download_name), output_store.content_hash(path), mimetype=DOCX_MIMETYPE)
+
+
+@app.route("/process_graf_file", methods=["POST"])
+def process_graf_file():
+    logger.info("PROCESSING FILE")
+    request.max_content_length = GRAF_REQUEST_SIZE
+    file = request.files.get("graf_file")
+    if file is None:
+        return {"success": False, "error": "Файл не передан"}, 400
+
+    spool_path = upload_store.temp_path('.xlsx')
+    content_hash = spool_upload(file, spool_path)
+
+    options = files_manifest.get_parsed(content_hash)
+    if options is not None:
+        # такой график уже разбирался (этим или другим пользователем)
+        logger.info("GRAF ALREADY PARSED, PARSING SKIPPED")
+    else:
+        try:
+            options = parse_graf_options(spool_path)
+        except Exception as e:
+            logger.info(f"Ошибка чтения графика: {e}")
+            options = None
+        if options is None:
+            # неподходящий файл не заменяет уже загруженный график
+            os.remove(spool_path)
+            return {
+                "success": False,
+                "error": "Неизвестный формат файла"
+            }, 500
+        files_manifest.save_parsed(content_hash, 'graf', options)
+
+    object_path = upload_store.put(spool_path, content_hash)
+    files_manifest.set_file(get_client_id(), 'graf', file.filename or 'graf.xlsx',
+                            os.path.basename(object_path), content_hash)
+
     logger.info("NUMERS: " + str(options))
     return {
         "success": True,
@@ -803,24 +1311,14 @@ def process_graf_file():
 
 @app.route("/preload_files", methods=["GET"])
 def preload_files():
-    with open("data/date_manager.txt", 'r') as manager:
-        files_names = manager.read().split('\n')
-        for i in range(len(files_names)):
-            if files_names[i] == '':
-                files_names.pop(i)
-        if len(files_names) == 0 or not any(line != '' for line in files_names):
-            return {
-                "success": True,
-                "files": None
-            }
-        files = []
-        for file_name in files_names:
-            files.append(file_name.split(';')[0])
-        logger.info("PRELOADING FILENAMES: " + str(files))
-        return {
-            "success": True,
-            "files": files
-        }
+    # файлы, удаленные очисткой хранилища, не предлагаются
+    files = [record['original_name'] for record in files_manifest.list_files(get_client_id())
+             if upload_store.get(record['object_name']) is not None]
+    logger.info("PRELOADING FILENAMES: " + str(files))
+    return {
+        "success": True,
+        "files": files or None
+    }
 
 
 @app.route("/upload_file", methods=["GET"])
@@ -828,26 +1326,46 @@ def upload_file():
     filename = request.args.get('name')
     logger.info(str(filename))
 
-    file_path = DATA_DIR / filename
+    record = files_manifest.find_file(get_client_id(), filename)
+    file_path = upload_store.get(record['object_name']) if record is not None else None
+    if file_path is None:
+        return {"success": False, "error": "Файл не найден"}, 404
     logger.info("UPLOADING FILE: " + str(file_path))
 
-    original_filename = 'file not exist'
-    with open('data/date_manager.txt', 'r') as manager:
-        file_lines = manager.read().split('\n')
-        for line in file_lines:
-            if filename in line:
-                original_filename = line.split(';')[1]
+    return send_download(file_path, record['original_name'], record['sha256'])
 
-    return send_file(
-        file_path,
-        as_attachment=True,
-        download_name=original_filename
-    )
+
+# сериализованный ответ /get_teams_list; пересобирается при смене версии данных или по TTL кэша БД
+teams_list_cache = {'version': None, 'loaded_at': 0.0, 'body': None, 'etag': None}
+teams_list_lock = threading.Lock()
 
 
 @app.route("/get_teams_list", methods=["GET"])
 def get_teams_list():
-    db.get_all_employees()
+    if not db.is_ready():
+        return {"success": False, "error": "БД недоступна"}, 503, {"Retry-After": "5"}
+
+    with teams_list_lock:
+        if (teams_list_cache['version'] != db.data_version
+                or time.monotonic() - teams_list_cache['loaded_at'] >= db.ttl):
+            version = db.data_version
+            teams = db.get_teams()
+            if teams is None:  # ошибка БД не кэшируется
+                return {"success": False, "error": "БД недоступна"}, 503, {"Retry-After": "5"}
+            body = json.dumps({"success": True, "teams": teams}, ensure_ascii=False)
+            teams_list_cache.update(version=version, loaded_at=time.monotonic(), body=body,
+                                    etag=hashlib.sha1(body.encode('utf-8')).hexdigest())
+        body, etag = teams_list_cache['body'], teams_list_cache['etag']
+
+    response = app.response_class(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+
+@app.route("/db_cache_stats", methods=["GET"])
+def db_cache_stats():
+    return db.cache_stats()
 
 
 @app.route("/download_sample", methods=["GET"])
@@ -869,9 +1387,46 @@ def check_network():
         "status": "server is running",
         "client_ip": client_host,
         "server_ip": "178.157.138.159",
+        "db_ready": db.is_ready(),
         "time": datetime.now().isoformat()
     }
 
 
+def warm_up():
+    """
+    Загружает все, что иначе считалось бы на первом запросе: разбор шаблона (блоки повторов,
+    реестр таблиц, раскладка приборов), таблица норм отбраковки, index.html, подключение к БД
+    и кэш сотрудников. Вызывается в главном процессе до fork (serve.py).
+    """
+    try:
+        processor = WordTemplateProcessor(TEMPLATE_PATH)
+        get_instrument_layout(processor)
+        application_processing.get_template_placeholders(TEMPLATE_PATH, processor.doc)
+    except Exception as e:  # без шаблона сервер все равно стартует, ошибка будет в /generate
+        logger.warning(f"Template warm-up failed: {e}")
+    application_processing.load_otbrak_data()
+    with app.app_context():
+        get_index_page()
+    if USE_DB and (db.is_ready() or db.connect()):
+        db.get_all_employees()
+    logger.info("warm-up done, db ready: " + str(db.is_ready()))
+
+
+def after_fork():
+    """
+    В новом воркере (gunicorn post_fork): блокировки, которые в момент fork мог держать поток
+    главного процесса (очистка хранилищ, прогрев), создаются заново - иначе их никто не отпустит
+    """
+    global index_page_lock, graf_rows_lock, render_sessions_lock, teams_list_lock
+    index_page_lock = threading.Lock()
+    graf_rows_lock = threading.Lock()
+    render_sessions_lock = threading.Lock()
+    teams_list_lock = threading.Lock()
+    output_store.after_fork()
+    upload_store.after_fork()
+    db.after_fork()
+    generate_admission.after_fork()
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000, debug=True)
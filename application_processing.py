@@ -1,8 +1,18 @@
+import io
+import os
 import random
+import re
 import struct
+import zipfile
+from copy import deepcopy
 from enum import Enum
+from xml.sax.saxutils import escape
 
-from docx.enum.table import WD_TABLE_ALIGNMENT
+from lxml import etree
+
+from docx import Document
+from docx.oxml import OxmlElement, parse_xml
+from docx.oxml.ns import nsdecls, qn
 from docx.table import Table
 
 import json
@@ -72,20 +82,38 @@ class Section:
         self.min_thick = min([min(_) for _ in self.thick_measure_results])
 
 
-
-def set_cell_format(cell, default_paragraph):
-    cell.vertical_alignment = WD_TABLE_ALIGNMENT.CENTER
-    for paragraph in cell.paragraphs:
-        paragraph.alignment = default_paragraph.alignment
-        paragraph.style = default_paragraph.style
-        for run in paragraph.runs:
-            run.font.size = default_paragraph.runs[0].font.size
-            run.font.name = default_paragraph.runs[0].font.name
-            run.font.color.rgb = default_paragraph.runs[0].font.color.rgb
-            run.style = default_paragraph.runs[0].style
-            run.italic = default_paragraph.runs[0].italic
-            run.underline = default_paragraph.runs[0].underline
-            run.bold = default_paragraph.runs[0].bold
+class CellFormatStamp:
+    """
+    Снимок форматирования эталонной ячейки для оформления новых строк таблицы.
+
+    XML свойств снимается один раз на таблицу: из w:pPr стиль и выравнивание абзаца,
+    из w:rPr стиль, шрифт, размер, цвет, курсив, подчеркивание и жирность.
+    Выравнивание ячейки по вертикали и ширины задает AppendixRowBuilder.
+    """
+    P_PR_TAGS = (qn('w:pStyle'), qn('w:jc'))
+    R_PR_TAGS = (qn('w:rStyle'), qn('w:rFonts'), qn('w:b'), qn('w:i'),
+                 qn('w:color'), qn('w:sz'), qn('w:u'))
+
+    def __init__(self, reference_cell):
+        default_paragraph = reference_cell.paragraphs[0]
+
+        self.p_pr = self._filtered_copy(default_paragraph._p.pPr, self.P_PR_TAGS, 'w:pPr')
+        first_run = default_paragraph._p.r_lst[0] if default_paragraph._p.r_lst else None
+        self.r_pr = self._filtered_copy(first_run.rPr if first_run is not None else None,
+                                        self.R_PR_TAGS, 'w:rPr')
+
+    @staticmethod
+    def _filtered_copy(element, tags, tag_name):
+        """Копия элемента свойств, в которой оставлены только нужные теги"""
+        if element is None:
+            return None
+        result = deepcopy(element)
+        for child in list(result):
+            if child.tag not in tags:
+                result.remove(child)
+        if len(result) == 0:
+            return None
+        return result
 
 
 import csv
@@ -210,85 +238,541 @@ def parse_csv_to_json(csv_file, json_file):
     with open(json_file, 'w', encoding='utf-8') as f:
         json.dump(result, f, ensure_ascii=False, indent=2)
 
-def add_row_pril_12_2(sections : list[Section], table : Table):
-    row_start_index = 3
-    for obj_number in range(len(sections)):
-        if not (sections[obj_number].type == SectionType.ZMS):
-            row_index = row_start_index + obj_number * 3
-            for _ in range(3):
-                table.add_row()
-            for coll_index in range(5):
-                table.row_cells(row_index)[coll_index].merge(table.row_cells(row_index + 2)[coll_index])
-            count_rows = 3
-        else:
-            row_index = row_start_index + obj_number
-            table.add_row()
-            count_rows = 1
+OTBRAK_TABLE_PATH = 'data/otbrak_table.json'
+_otbrak_cache = {}
 
-        curr_section = sections[obj_number]
-        table.row_cells(row_index)[0].text = f'{curr_section.number}\n{curr_section.type.value}'
-        table.row_cells(row_index)[1].text = f'{curr_section.picket}'
 
-        table.row_cells(row_index)[2].text = f'{curr_section.du}'
-        table.row_cells(row_index)[3].text = f"{str(float(curr_section.area_nominal)).replace('.', ',')}"
-        # table.row_cells(row_index)[4].text = 'ПОТОМ'
+def load_otbrak_data():
+    """Таблица норм отбраковки; читается один раз на версию файла (только для чтения)"""
+    key = (OTBRAK_TABLE_PATH, os.path.getmtime(OTBRAK_TABLE_PATH))
+    if key not in _otbrak_cache:
+        _otbrak_cache.clear()
+        with open(OTBRAK_TABLE_PATH, 'br') as f:
+            _otbrak_cache[key] = json.load(f)
+    return _otbrak_cache[key]
 
-        with open('data/otbrak_table.json', 'br') as f:
-            otbrak_data = json.load(f)
 
-        if curr_section.type != SectionType.ZMS:
-            # TODO сейчас давление, диаметр заданы строго, надо как-то заменить
+def pril_12_2_row_texts(curr_section: Section, otbrak_data) -> list[dict[int, str]]:
+    """Тексты ячеек строк секции в приложении 12 ({номер столбца: текст} на каждую строку)"""
+    count_rows = 1 if curr_section.type == SectionType.ZMS else 3
+    rows = [dict() for _ in range(count_rows)]
 
-            # TODO также проверить как оно с дробными значениями, где они нужны и тд.
-            # Также некоторые числа строки в json, мб поменять
+    rows[0][0] = f'{curr_section.number}\n{curr_section.type.value}'
+    rows[0][1] = f'{curr_section.picket}'
 
-            # TODO шурф == отвод???
-            if curr_section.type.value == 'Шурф':
-                table.row_cells(row_index)[4].text = str(otbrak_data[curr_section.steel]['вода']['16'][str(curr_section.du)]['отвод']['принятое']).replace('.', ',')
-            else:
-                table.row_cells(row_index)[4].text = str(otbrak_data[curr_section.steel]['вода']['16'][str(curr_section.du)][curr_section.type.value]['принятое']).replace('.', ',')
-        else:
-            table.row_cells(row_index)[4].text = 'HZ'
-            # TODO сделать для ЗМС, нужно спросить
+    rows[0][2] = f'{curr_section.du}'
+    rows[0][3] = f"{str(float(curr_section.area_nominal)).replace('.', ',')}"
+    # rows[0][4] = 'ПОТОМ'
 
+    if curr_section.type != SectionType.ZMS:
+        # TODO сейчас давление, диаметр заданы строго, надо как-то заменить
 
-        for i in range(count_rows):
-            for j in range(len(curr_section.thick_measure_results[i])):
-                table.row_cells(row_index + i)[5 + j].text = str(curr_section.thick_measure_results[i][j])
+        # TODO также проверить как оно с дробными значениями, где они нужны и тд.
+        # Также некоторые числа строки в json, мб поменять
 
-        # setting style
+        # TODO шурф == отвод???
+        if curr_section.type.value == 'Шурф':
+            rows[0][4] = str(otbrak_data[curr_section.steel]['вода']['16'][str(curr_section.du)]['отвод']['принятое']).replace('.', ',')
+        else:
+            rows[0][4] = str(otbrak_data[curr_section.steel]['вода']['16'][str(curr_section.du)][curr_section.type.value]['принятое']).replace('.', ',')
+    else:
+        rows[0][4] = 'HZ'
+        # TODO сделать для ЗМС, нужно спросить
+
+    for i in range(count_rows):
+        for j in range(len(curr_section.thick_measure_results[i])):
+            rows[i][5 + j] = str(curr_section.thick_measure_results[i][j])
+    return rows
+
+
+def pril_13_row_texts(curr_section: Section) -> list[dict[int, str]]:
+    """Тексты ячеек строки секции в приложении 13"""
+    row = {
+        0: f'{curr_section.number}',
+        1: f'{curr_section.type.value}',
+        2: f'{curr_section.picket}',
+        3: f'{curr_section.du}',
+        4: f"{curr_section.steel}",
+    }
+    for j in range(len(curr_section.diam_measure_results)):
+        row[5 + j] = str(curr_section.diam_measure_results[j])
+    return [row]
+
+
+class AppendixRowBuilder:
+    """
+    Строки таблицы приложения (XML w:tr) по текстам ячеек секции, в оформлении первой ячейки таблицы.
+
+    Один построитель для обоих способов записи: add_row_pril_* добавляет строки в DOM,
+    AppendixStreamWriter пишет те же строки потоком при сохранении. row_texts(section)
+    возвращает строки секции в формате pril_*_row_texts, столбцы merge_columns
+    многострочной секции объединяются по вертикали.
+    """
+
+    def __init__(self, table: Table, row_texts, merge_columns=()):
+        self.row_texts = row_texts
+        self.merge_columns = set(merge_columns)
+        format_stamp = CellFormatStamp(table.cell(0, 0))
+        self.p_pr = etree.tostring(format_stamp.p_pr, encoding='unicode') if format_stamp.p_pr is not None else ''
+        self.r_pr = etree.tostring(format_stamp.r_pr, encoding='unicode') if format_stamp.r_pr is not None else ''
+        self.widths = [gridCol.w.twips if gridCol.w is not None else None
+                       for gridCol in table._tbl.tblGrid.gridCol_lst]
+
+    def _cell_xml(self, text, width, v_merge):
+        tc_pr = '<w:tcPr>'
+        if width is not None:
+            tc_pr += f'<w:tcW w:w="{width}" w:type="dxa"/>'
+        if v_merge is not None:
+            tc_pr += f'<w:vMerge w:val="{v_merge}"/>' if v_merge else '<w:vMerge/>'
+        tc_pr += '<w:vAlign w:val="center"/></w:tcPr>'
+
+        if text is None:
+            return f'<w:tc>{tc_pr}<w:p>{self.p_pr}</w:p></w:tc>'
+        lines = '<w:br/>'.join(f'<w:t xml:space="preserve">{escape(line)}</w:t>' for line in text.split('\n'))
+        return f'<w:tc>{tc_pr}<w:p>{self.p_pr}<w:r>{self.r_pr}{lines}</w:r></w:p></w:tc>'
+
+    def rows_xml(self, section, tr_attributes=''):
+        """XML строк одной секции; tr_attributes - объявления пространств имен для разбора отдельно от документа"""
+        rows = self.row_texts(section)
+        for i in range(len(rows)):
+            cells = []
+            for coll_index in range(len(self.widths)):
+                v_merge = None
+                if len(rows) > 1 and coll_index in self.merge_columns:
+                    v_merge = 'restart' if i == 0 else ''
+                cells.append(self._cell_xml(rows[i].get(coll_index), self.widths[coll_index], v_merge))
+            yield f'<w:tr{tr_attributes}>' + ''.join(cells) + '</w:tr>'
+
+    def append_rows(self, table: Table, sections):
+        """Добавляет строки секций в конец таблицы документа"""
+        tr_attributes = ' ' + nsdecls('w')
+        for section in sections:
+            for row_xml in self.rows_xml(section, tr_attributes):
+                table._tbl.append(parse_xml(row_xml))
+
+
+def pril_12_2_row_builder(table: Table) -> AppendixRowBuilder:
+    otbrak_data = load_otbrak_data()
+    return AppendixRowBuilder(table, lambda section: pril_12_2_row_texts(section, otbrak_data),
+                              merge_columns=range(5))
+
+
+def pril_13_row_builder(table: Table) -> AppendixRowBuilder:
+    return AppendixRowBuilder(table, pril_13_row_texts)
 
-        default_paragraph = table.row_cells(0)[0].paragraphs[0]
 
-        for i in range(count_rows):
-            for j in range(len(table.row_cells(row_index + i))):
-                set_cell_format(table.row_cells(row_index + i)[j], default_paragraph)
+def add_row_pril_12_2(sections : list[Section], table : Table):
+    pril_12_2_row_builder(table).append_rows(table, sections)
 
 
 def add_row_pril_13(sections: list[Section], table: Table):
-    row_start_index = 3
-    for obj_number in range(len(sections)):
-        row_index = row_start_index + obj_number
-        table.add_row()
-
-        curr_section = sections[obj_number]
-        table.row_cells(row_index)[0].text = f'{curr_section.number}'
-        table.row_cells(row_index)[1].text = f'{curr_section.type.value}'
-        table.row_cells(row_index)[2].text = f'{curr_section.picket}'
-
-        table.row_cells(row_index)[3].text = f'{curr_section.du}'
-        table.row_cells(row_index)[4].text = f"{curr_section.steel}"
-        # table.row_cells(row_index)[4].text = 'ПОТОМ'
-
-        with open('data/otbrak_table.json', 'br') as f:
-            otbrak_data = json.load(f)
-
-        for j in range(len(curr_section.diam_measure_results)):
-            table.row_cells(row_index)[5 + j].text = str(curr_section.diam_measure_results[j])
-
-        # setting style
-
-        default_paragraph = table.row_cells(0)[0].paragraphs[0]
-
-        for j in range(len(table.row_cells(row_index))):
-            set_cell_format(table.row_cells(row_index)[j], default_paragraph)
+    pril_13_row_builder(table).append_rows(table, sections)
+
+
+class AppendixStreamWriter:
+    """
+    Потоковая запись строк таблиц приложений прямо в document.xml.
+
+    Вместо добавления строк в DOM python-docx в таблицу ставится маркер
+    (XML-комментарий), а при сохранении строки генерируются по одной секции
+    из переданного итерируемого объекта и сразу пишутся в архив .docx.
+    Память не растет с количеством секций.
+    """
+    MARKER = 'appendix-stream-{}'
+
+    def __init__(self):
+        self._tables = []
+
+    def add_table(self, table: Table, sections, row_builder: AppendixRowBuilder):
+        """
+        Регистрирует таблицу для потоковой записи.
+
+        sections может быть генератором, он будет прочитан один раз при save;
+        строки строит row_builder, тот же, что и при записи в DOM.
+        """
+        marker = self.MARKER.format(len(self._tables))
+        table._tbl.append(etree.Comment(marker))
+        self._tables.append({
+            'marker': f'<!--{marker}-->'.encode('utf-8'),
+            'sections': sections,
+            'row_builder': row_builder,
+        })
+
+    @staticmethod
+    def _rows_xml(spec):
+        """Генератор XML строк таблицы, по одной секции за раз"""
+        for section in spec['sections']:
+            for row_xml in spec['row_builder'].rows_xml(section):
+                yield row_xml.encode('utf-8')
+
+    def _write_document_xml(self, document_xml: bytes, out):
+        position = 0
+        specs = sorted(self._tables, key=lambda spec: document_xml.index(spec['marker']))
+        for spec in specs:
+            marker_position = document_xml.index(spec['marker'])
+            out.write(document_xml[position:marker_position])
+            for row_xml in self._rows_xml(spec):
+                out.write(row_xml)
+            position = marker_position + len(spec['marker'])
+        out.write(document_xml[position:])
+
+    def save(self, doc, output_path):
+        """Сохраняет документ, дописывая строки таблиц в архив по мере генерации"""
+        buffer = io.BytesIO()
+        doc.save(buffer)
+        with zipfile.ZipFile(buffer) as src, zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as dst:
+            for item in src.infolist():
+                if item.filename == 'word/document.xml':
+                    with dst.open(item.filename, 'w') as out:
+                        self._write_document_xml(src.read(item), out)
+                else:
+                    dst.writestr(item, src.read(item))
+
+
+def stream_row_pril_12_2(sections, table: Table, writer: AppendixStreamWriter):
+    writer.add_table(table, sections, pril_12_2_row_builder(table))
+
+
+def stream_row_pril_13(sections, table: Table, writer: AppendixStreamWriter):
+    writer.add_table(table, sections, pril_13_row_builder(table))
+
+
+REPEAT_MARKER_RE = re.compile(r'\{\{#repeat\s+(\w+)\s*\}\}')
+ITEM_FIELD_RE = re.compile(r'\{\{item((?:\.\w+)*)\}\}')
+
+
+def resolve_item_field(item, path: str):
+    """Значение поля item.a.b.0: атрибут, ключ словаря или индекс списка; если нет - пустая строка"""
+    value = item
+    for name in path.split('.'):
+        if name == '':
+            continue
+        if isinstance(value, dict):
+            value = value.get(name)
+        elif name.isdigit() and isinstance(value, (list, tuple)):
+            index = int(name)
+            value = value[index] if index < len(value) else None
+        else:
+            value = getattr(value, name, None)
+        if value is None:
+            return ''
+    if isinstance(value, Enum):
+        value = value.value
+    return str(value)
+
+
+class RepeatRowBlock:
+    """
+    Строка таблицы шаблона, размножаемая по коллекции.
+
+    В любой ячейке строки ставится маркер {{#repeat имя_коллекции}}, а в ячейках
+    поля элемента: {{item.picket}}, {{item.type}}, {{item.diam_measure_results.0}}.
+    При компиляции маркер убирается, плейсхолдеры каждого абзаца сводятся в первый
+    run, и для каждого w:t запоминается его номер и список полей. При рендере строка
+    только клонируется и в нужные w:t подставляются значения.
+
+    Таблицы приложений 12 и 13 так не строятся: блок размножает одну строку, а секция
+    приложения 12 (не ЗМС) занимает три строки с объединенными по вертикали ячейками,
+    и для больших отчетов строки нужно писать потоком (AppendixStreamWriter), а не в DOM.
+    Их строки строит один AppendixRowBuilder (тексты из pril_12_2_row_texts / pril_13_row_texts),
+    add_row_pril_* и stream_row_pril_* отличаются только тем, куда пишутся готовые w:tr.
+    """
+
+    def __init__(self, table_position: int, row_position: int, collection: str, tr):
+        self.table_position = table_position
+        self.row_position = row_position
+        self.collection = collection
+        self.tr = tr
+        self.text_fields = []  # (номер w:t в строке, шаблон с {}, пути полей)
+
+        for index, t in enumerate(self.tr.iter(qn('w:t'))):
+            paths = ITEM_FIELD_RE.findall(t.text or '')
+            if paths:
+                self.text_fields.append((index, self._compile_pattern(t.text), paths))
+
+    @staticmethod
+    def _compile_pattern(text: str) -> str:
+        parts = ITEM_FIELD_RE.split(text)
+        # split с группой дает [текст, путь, текст, путь, ..., текст]
+        return '{}'.join(part.replace('{', '{{').replace('}', '}}') for part in parts[::2])
+
+    def render_rows(self, items):
+        """Генератор готовых w:tr для элементов коллекции"""
+        t_tag = qn('w:t')
+        for item in items:
+            tr = deepcopy(self.tr)
+            text_elements = list(tr.iter(t_tag))
+            for index, pattern, paths in self.text_fields:
+                text = pattern.format(*(resolve_item_field(item, path) for path in paths))
+                set_text_with_breaks(text_elements[index], text)
+            yield tr
+
+
+def set_text_with_breaks(t, text: str):
+    """Записывает текст в w:t, переводы строк превращает в w:br как python-docx"""
+    lines = text.split('\n')
+    t.text = lines[0]
+    t.set(qn('xml:space'), 'preserve')
+    anchor = t
+    for line in lines[1:]:
+        br = OxmlElement('w:br')
+        anchor.addnext(br)
+        new_t = OxmlElement('w:t')
+        new_t.text = line
+        new_t.set(qn('xml:space'), 'preserve')
+        br.addnext(new_t)
+        anchor = new_t
+
+
+def _collapse_paragraph_runs(p):
+    """Сводит текст абзаца с плейсхолдерами в первый run, чтобы поле не было разрезано"""
+    t_elements = list(p.iter(qn('w:t')))
+    if len(t_elements) < 2 or '{{' not in ''.join(t.text or '' for t in t_elements):
+        return
+    t_elements[0].text = ''.join(t.text or '' for t in t_elements)
+    for t in t_elements[1:]:
+        t.getparent().remove(t)
+
+
+def compile_repeat_blocks(doc) -> list[RepeatRowBlock]:
+    """Находит в документе строки с {{#repeat ...}} и компилирует их"""
+    blocks = []
+    for table_position, tbl in enumerate(doc.element.body.iter(qn('w:tbl'))):
+        for row_position, tr in enumerate(tbl.tr_lst):
+            row_text = ''.join(t.text or '' for t in tr.iter(qn('w:t')))
+            if '{{#repeat' not in row_text:
+                continue
+            template_tr = deepcopy(tr)
+            for p in template_tr.iter(qn('w:p')):
+                _collapse_paragraph_runs(p)
+            collection = None
+            for t in template_tr.iter(qn('w:t')):
+                match = REPEAT_MARKER_RE.search(t.text or '')
+                if match:
+                    collection = match.group(1)
+                    t.text = REPEAT_MARKER_RE.sub('', t.text)
+            if collection is None:
+                raise Exception(f"bad repeat marker in table {table_position}, row {row_position}")
+            blocks.append(RepeatRowBlock(table_position, row_position, collection, template_tr))
+    return blocks
+
+
+_repeat_blocks_cache = {}
+
+
+def get_repeat_blocks(template_path, doc) -> list[RepeatRowBlock]:
+    """Скомпилированные блоки шаблона; компиляция один раз на файл шаблона (до его изменения)"""
+    key = (str(template_path), os.path.getmtime(template_path))
+    if key not in _repeat_blocks_cache:
+        _repeat_blocks_cache[key] = compile_repeat_blocks(doc)
+    return _repeat_blocks_cache[key]
+
+
+def render_repeat_blocks(doc, blocks: list[RepeatRowBlock], collections: dict):
+    """Заменяет строки-шаблоны в документе строками по коллекциям"""
+    if not blocks:
+        return
+    tables = list(doc.element.body.iter(qn('w:tbl')))
+    # сначала находим все строки, потом меняем, чтобы позиции не съехали
+    targets = [(block, tables[block.table_position].tr_lst[block.row_position]) for block in blocks]
+    for block, template_tr in targets:
+        anchor = template_tr
+        for tr in block.render_rows(collections.get(block.collection, [])):
+            anchor.addnext(tr)
+            anchor = tr
+        template_tr.getparent().remove(template_tr)
+
+
+TABLE_MARKER_RE = re.compile(r'\{\{table:(\w+)\}\}')
+
+
+class TableRegistry:
+    """
+    Реестр таблиц шаблона по стабильным якорям вместо doc.tables[index].
+
+    Якорем таблицы служит (в порядке приоритета) маркер {{table:имя}} в первой
+    ячейке, закладка внутри таблицы или в абзаце перед ней, текст подписи
+    (абзац со стилем Caption перед таблицей). Для шаблонов без якорей можно
+    передать имена по старым индексам в default_names. Строится один раз на
+    шаблон, для документа запроса bind() за один проход дает словарь имя -> w:tbl.
+    """
+
+    def __init__(self, doc, default_names: dict = None):
+        self.positions = {}  # имя -> номер таблицы среди таблиц body
+        for position, tbl in enumerate(doc.element.body.tbl_lst):
+            for name in self._anchors(tbl):
+                self.positions.setdefault(name, position)
+        for name, position in (default_names or {}).items():
+            self.positions.setdefault(name, position)
+
+    def _anchors(self, tbl):
+        first_tc = next(tbl.iter(qn('w:tc')), None)
+        if first_tc is not None:
+            first_cell_text = ''.join(t.text or '' for t in first_tc.iter(qn('w:t')))
+            yield from TABLE_MARKER_RE.findall(first_cell_text)
+
+        for bookmark in tbl.iter(qn('w:bookmarkStart')):
+            yield bookmark.get(qn('w:name'))
+
+        previous = tbl.getprevious()
+        if previous is not None and previous.tag == qn('w:p'):
+            for bookmark in previous.iter(qn('w:bookmarkStart')):
+                yield bookmark.get(qn('w:name'))
+            style = previous.find(f"{qn('w:pPr')}/{qn('w:pStyle')}")
+            if style is not None and style.get(qn('w:val')) == 'Caption':
+                yield ''.join(t.text or '' for t in previous.iter(qn('w:t'))).strip()
+
+    def bind(self, doc) -> dict:
+        """Словарь имя -> w:tbl для конкретного документа (клона шаблона)"""
+        tbl_lst = doc.element.body.tbl_lst
+        tables = {name: tbl_lst[position] for name, position in self.positions.items()
+                  if position < len(tbl_lst)}
+        for tbl in tables.values():
+            first_tc = next(tbl.iter(qn('w:tc')), None)
+            if first_tc is None:
+                continue
+            for t in first_tc.iter(qn('w:t')):
+                if t.text and '{{table:' in t.text:
+                    t.text = TABLE_MARKER_RE.sub('', t.text)
+        return tables
+
+
+_table_registry_cache = {}
+
+
+def get_table_registry(template_path, doc, default_names: dict = None) -> TableRegistry:
+    """Реестр таблиц шаблона; строится один раз на файл шаблона (до его изменения)"""
+    key = (str(template_path), os.path.getmtime(template_path))
+    if key not in _table_registry_cache:
+        _table_registry_cache[key] = TableRegistry(doc, default_names)
+    return _table_registry_cache[key]
+
+
+PLACEHOLDER_RE = re.compile(r'\{\{([^{}]+)\}\}')
+# служебные маркеры шаблона, которые не заменяются из словаря замен
+SERVICE_PLACEHOLDER_PREFIXES = ('#', '/', 'item.', 'table:')
+
+
+def is_service_placeholder(name: str) -> bool:
+    """Маркер блока, таблицы или поле элемента ({{item}}, {{item.picket}}), но не {{items_count}}"""
+    name = name.strip()
+    return name == 'item' or name.startswith(SERVICE_PLACEHOLDER_PREFIXES)
+
+
+def compile_placeholders(doc) -> set[str]:
+    """Все плейсхолдеры {{имя}} шаблона: основной текст, таблицы и колонтитулы"""
+    placeholders = set()
+    for part in doc.part.package.iter_parts():
+        element = getattr(part, '_element', None)
+        if element is None:
+            continue
+        for p in element.iter(qn('w:p')):
+            # плейсхолдер может быть разбит на несколько run, поэтому текст абзаца целиком
+            text = ''.join(t.text or '' for t in p.iter(qn('w:t')))
+            for name in PLACEHOLDER_RE.findall(text):
+                if not is_service_placeholder(name):
+                    placeholders.add('{{' + name + '}}')
+    return placeholders
+
+
+_placeholders_cache = {}
+
+
+def get_template_placeholders(template_path, doc=None) -> set[str]:
+    """Плейсхолдеры шаблона; шаблон читается только при первом обращении (до его изменения)"""
+    key = (str(template_path), os.path.getmtime(template_path))
+    if key not in _placeholders_cache:
+        _placeholders_cache[key] = compile_placeholders(doc if doc is not None else Document(template_path))
+    return _placeholders_cache[key]
+
+
+def _split_run_after(t):
+    """Переносит все, что в run идет после t, в новый run с тем же оформлением сразу за ним"""
+    r = t.getparent()
+    tail = list(t.itersiblings())
+    if not tail:
+        return
+    new_r = OxmlElement('w:r')
+    if r.rPr is not None:
+        new_r.append(deepcopy(r.rPr))
+    for element in tail:
+        new_r.append(element)
+    r.addnext(new_r)
+
+
+def isolate_placeholders(element, skip_tables=()) -> dict[str, list]:
+    """
+    Выносит каждый плейсхолдер {{имя}} внутри element в отдельный run (с оформлением run,
+    где плейсхолдер начинался) и возвращает карту {плейсхолдер: [w:r]}.
+    По этой карте значение потом меняется без повторного обхода документа (set_run_text).
+    Абзацы внутри таблиц из skip_tables пропускаются
+    """
+    slots = {}
+    t_tag = qn('w:t')
+    for p in element.iter(qn('w:p')):
+        if skip_tables and any(tbl in skip_tables for tbl in p.iterancestors(qn('w:tbl'))):
+            continue
+        t_elements = [t for t in p.iter(t_tag) if t.getparent().tag == qn('w:r')]
+        text = ''.join(t.text or '' for t in t_elements)
+        if '{{' not in text:
+            continue
+        offsets = []  # (начало текста w:t в тексте абзаца, исходная длина, w:t)
+        position = 0
+        for t in t_elements:
+            offsets.append((position, len(t.text or ''), t))
+            position += len(t.text or '')
+
+        def locate(index):
+            for start, length, t in offsets:
+                if start <= index < start + length:
+                    return start, t
+
+        matches = [match for match in PLACEHOLDER_RE.finditer(text)
+                   if not is_service_placeholder(match.group(1))]
+        # с конца абзаца, чтобы смещения еще не обработанных плейсхолдеров не менялись
+        for match in reversed(matches):
+            start_offset, t_start = locate(match.start())
+            end_offset, t_end = locate(match.end() - 1)
+            suffix = (t_end.text or '')[match.end() - end_offset:]
+            t_start_text = t_start.text or ''
+            if t_start is t_end:
+                t_start.text = t_start_text[:match.start() - start_offset]
+                if suffix:
+                    suffix_t = OxmlElement('w:t')
+                    suffix_t.text = suffix
+                    suffix_t.set(qn('xml:space'), 'preserve')
+                    t_start.addnext(suffix_t)
+            else:
+                inside = False
+                for _, _, t in offsets:
+                    if t is t_start:
+                        inside = True
+                    elif t is t_end:
+                        break
+                    elif inside:
+                        t.text = ''
+                t_start.text = t_start_text[:match.start() - start_offset]
+                t_end.text = suffix
+            t_start.set(qn('xml:space'), 'preserve')
+            _split_run_after(t_start)
+
+            r = t_start.getparent()
+            slot = OxmlElement('w:r')
+            if r.rPr is not None:
+                slot.append(deepcopy(r.rPr))
+            slot_t = OxmlElement('w:t')
+            slot_t.text = match.group(0)
+            slot.append(slot_t)
+            r.addnext(slot)
+            slots.setdefault(match.group(0), []).append(slot)
+    return slots
+
+
+def set_run_text(r, text: str):
+    """Заменяет содержимое run (кроме оформления) текстом с переводами строк"""
+    for child in list(r):
+        if child.tag != qn('w:rPr'):
+            r.remove(child)
+    t = OxmlElement('w:t')
+    r.append(t)
+    set_text_with_breaks(t, text)
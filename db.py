@@ -1,11 +1,19 @@
+import json
 import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime
 from sqlalchemy import (
     create_engine, MetaData, Table, Column,
-    Integer, String, DateTime, ForeignKey, text
+    Integer, String, Text, DateTime, ForeignKey, UniqueConstraint, select, text, func, and_, event
 )
-from sqlalchemy.orm import sessionmaker, relationship, declarative_base
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import sessionmaker, relationship, declarative_base, scoped_session, aliased, validates
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError, OperationalError, InterfaceError, DisconnectionError
 from dotenv import load_dotenv
 
 
@@ -15,16 +23,128 @@ load_dotenv()
 # Получаем URL базы данных
 DATABASE_URL = os.getenv('DATABASE_URL')
 
-if not DATABASE_URL:
-    raise ValueError("EXTERNAL_DATABASE_URL не найден в переменных окружения")
+# Встроенная SQLite без сервера БД (для небольших участков): SQLITE_PATH=data/autosubstitution.db
+SQLITE_PATH = os.getenv('SQLITE_PATH')
+if not DATABASE_URL and SQLITE_PATH:
+    os.makedirs(os.path.dirname(os.path.abspath(SQLITE_PATH)), exist_ok=True)
+    DATABASE_URL = f"sqlite:///{SQLITE_PATH}"
 
-# Создаем подключение
-engine = create_engine(DATABASE_URL)
+IS_SQLITE = bool(DATABASE_URL) and DATABASE_URL.startswith('sqlite')
+
+# PRAGMA для каждого соединения SQLite: WAL (чтение не блокируется записью), умеренный fsync,
+# ожидание блокировки вместо ошибки, кэш страниц и mmap в памяти процесса
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'foreign_keys': 'ON',
+    'busy_timeout': os.getenv('SQLITE_BUSY_TIMEOUT', '5000'),
+    'cache_size': os.getenv('SQLITE_CACHE_SIZE', '-20000'),  # отрицательное - в КиБ
+    'temp_store': 'MEMORY',
+    'mmap_size': os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)),
+}
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+# Настройки пула соединений
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))  # секунды
+
+# Время жизни кэша сотрудников, секунды
+DB_CACHE_TTL = int(os.getenv('DB_CACHE_TTL', '300'))
+
+# Размер пачки строк при массовом импорте
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '1000'))
+
+# Русские заголовки листов импорта -> колонки моделей
+IMPORT_COLUMNS = {
+    'Фамилия': 'surname',
+    'Имя': 'name',
+    'Отчество': 'lastname',
+    'Бригада': 'team_number',
+    'Номер бригады': 'team_number',
+    'Должность': 'position',
+    'Удостоверение': 'license',
+    'Номер удостоверения': 'license_number',
+    'Область': 'license',
+    'Действует до': 'license_end_date',
+}
+
+# Значения колонок, которых нет в файле, только для новых записей (существующие не затираются)
+IMPORT_DEFAULTS = {
+    'employees': {'position': "Специалист НК II уровня", 'license_number': "NONE"},
+}
+
+# Повторные попытки подключения при старте: 0 - пока не получится
+DB_CONNECT_RETRIES = int(os.getenv('DB_CONNECT_RETRIES', '0'))
+DB_CONNECT_BACKOFF = float(os.getenv('DB_CONNECT_BACKOFF', '1'))  # секунды, удваивается
+DB_CONNECT_BACKOFF_MAX = float(os.getenv('DB_CONNECT_BACKOFF_MAX', '60'))
+# сколько ждать ответа сервера БД при подключении: без этого запрос к пропавшей БД висит минутами
+DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', '5'))  # секунды
+
+# Один движок (и один пул) на процесс, создается при первом обращении
+engine = None
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Создает движок при первом обращении; к самой БД при этом не подключается"""
+    global engine
+    with _engine_lock:
+        if engine is None:
+            if not DATABASE_URL:
+                raise ValueError("EXTERNAL_DATABASE_URL не найден в переменных окружения")
+            connect_args = {}
+            if DATABASE_URL.startswith(('postgresql', 'mysql')):
+                connect_args['connect_timeout'] = DB_CONNECT_TIMEOUT
+            engine = create_engine(
+                DATABASE_URL,
+                connect_args=connect_args,
+                pool_size=DB_POOL_SIZE,
+                max_overflow=DB_MAX_OVERFLOW,
+                pool_pre_ping=DB_POOL_PRE_PING,
+                pool_recycle=DB_POOL_RECYCLE,
+            )
+            if IS_SQLITE:
+                event.listen(engine, 'connect', set_sqlite_pragmas)
+            SessionLocal.configure(bind=engine)
+    return engine
+
+# Асинхронный драйвер для той же базы (для FastAPI): можно задать явно через ASYNC_DATABASE_URL
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+    'mysql': 'mysql+aiomysql',
+    'mysql+pymysql': 'mysql+aiomysql',
+}
+
+
+def to_async_url(url):
+    scheme, rest = url.split('://', 1)
+    return f"{ASYNC_DRIVERS.get(scheme, scheme)}://{rest}"
+
+
+ASYNC_DATABASE_URL = os.getenv('ASYNC_DATABASE_URL') or (to_async_url(DATABASE_URL) if DATABASE_URL else None)
 
 # Создаем базовый класс для моделей (исправленная строка)
 Base = declarative_base()
 
 
+def normalize_surname(surname):
+    """Фамилия для поиска: без пробелов по краям, в нижнем регистре, е вместо ё"""
+    if surname is None:
+        return None
+    return surname.strip().lower().replace('ё', 'е')
+
+
 # Определяем модели с использованием ORM классов
 class Employee(Base):
     __tablename__ = 'employees'
@@ -32,8 +152,9 @@ class Employee(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String(100), nullable=False)
     surname = Column(String(100), nullable=False)
+    surname_normalized = Column(String(100), index=True)  # заполняется автоматически из surname
     lastname = Column(String(100))
-    team_number = Column(Integer, nullable=False)
+    team_number = Column(Integer, nullable=False, index=True)
     position = Column(String(100), nullable=False, default="Специалист НК II уровня")
     license = Column(String(100), nullable=False)
     license_number = Column(String(100), nullable=False)
@@ -43,6 +164,11 @@ class Employee(Base):
     # licenses = relationship("License", back_populates="employee", lazy='joined')
 
 
+    @validates('surname')
+    def _set_surname_normalized(self, key, surname):
+        self.surname_normalized = normalize_surname(surname)
+        return surname
+
     def get_info(self):
         info = dict()
         info['id'] = self.id
@@ -59,6 +185,7 @@ class License(Base): # rename: position -> license
     id = Column(Integer, primary_key=True, autoincrement=True, nullable=False)
     # employees_id = Column(Integer, ForeignKey('employees.id'), nullable=False)
     # license_number = Column(String(100), ForeignKey('employees.license_number'), nullable=False)
+    license_number = Column(String(100), index=True)
     license = Column(String(200), nullable=False)
     license_end_date = Column(DateTime, nullable=False)
 
@@ -68,27 +195,201 @@ class License(Base): # rename: position -> license
     def get_info(self):
         info = dict()
         info['id'] = self.id
-        info['employees_id'] = self.employees_id
+        info['license_number'] = self.license_number
         info['license'] = self.license
         info['license_end_date'] = self.license_end_date
         return info
 
 
+class Instrument(Base):
+    """Средство измерений бригады (строка таблицы приборов шаблона)"""
+    __tablename__ = 'instruments'
+    __table_args__ = (UniqueConstraint('team_number', 'slot'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    team_number = Column(Integer, nullable=False, index=True)
+    slot = Column(Integer, nullable=False)  # номер строки в таблице приборов шаблона
+    kind = Column(String(200))  # наименование: "Дефектоскоп", "Линейка", ...
+    model = Column(String(200))
+    serial = Column(String(100))  # заводской номер
+    certificate = Column(String(100))  # номер свидетельства о поверке
+    valid_until = Column(DateTime, index=True)  # срок поверки
+    valid_until_raw = Column(String(100))  # исходный текст срока, он и выводится в отчет
+
+    def get_info(self):
+        info = dict()
+        info['id'] = self.id
+        info['team_number'] = self.team_number
+        info['slot'] = self.slot
+        info['kind'] = self.kind
+        info['model'] = self.model
+        info['serial'] = self.serial
+        info['certificate'] = self.certificate
+        info['valid_until'] = self.valid_until
+        return info
+
+
+class TeamPrilojenie(Base):
+    """Готовые строки приложений 5-14 бригады, пересчитываются при смене ее приборов"""
+    __tablename__ = 'team_prilojenie'
+
+    team_number = Column(Integer, primary_key=True)
+    layout_key = Column(String(40), nullable=False)  # хэш таблицы приборов шаблона
+    data = Column(Text, nullable=False)  # JSON {плейсхолдер: текст}
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+
+def is_connection_error(error):
+    """Ошибка из-за недоступной БД или оборванного соединения, а не из-за самого запроса"""
+    return (isinstance(error, (OperationalError, InterfaceError, DisconnectionError))
+            or getattr(error, 'connection_invalidated', False))
+
+
 class DatabaseManager:
     def __init__(self):
-        self.engine = create_engine(DATABASE_URL)
-        self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        # сессия запроса: одна на поток между begin_request и end_request
+        self.request_session = scoped_session(SessionLocal)
+        self._request_state = threading.local()
+        self.is_embedded = IS_SQLITE
+        self.ready = threading.Event()
+        self._ready_lock = threading.Lock()
+        self.last_error = None
+
+    @property
+    def engine(self):
+        return get_engine()
+
+    @property
+    def SessionLocal(self):
+        get_engine()
+        return SessionLocal
+
+    def connect(self):
+        """
+        Проверяет соединение с БД (встроенной базе создает схему) и добавляет в существующие
+        таблицы новые колонки, True если БД доступна. Без колонок модели запросы к таблицам падают,
+        поэтому БД не считается готовой, пока обновление не прошло
+        """
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+            if self.is_embedded:
+                Base.metadata.create_all(self.engine)
+        except Exception as e:  # в том числе отсутствующий драйвер и неверный URL
+            self.last_error = str(e)
+            return False
+        if not self.upgrade_tables():
+            return False
+        self.last_error = None
+        self.ready.set()
+        return True
+
+    def is_ready(self):
+        return self.ready.is_set()
+
+    def connection_lost(self, error):
+        """
+        Вызывается при ошибке запроса: если БД пропала, она считается недоступной (генерация
+        берет данные из снимка), пока фоновое подключение не восстановит соединение
+        """
+        if not is_connection_error(error):
+            return
+        with self._ready_lock:
+            if not self.ready.is_set():
+                return
+            self.ready.clear()
+        self.last_error = str(error)
+        print(f"Соединение с БД потеряно: {error}")
+        self.start_warmup()
+
+    def start_warmup(self):
+        """Подключается к БД в фоне с повторами, приложение стартует не дожидаясь БД"""
+        thread = threading.Thread(target=self._warmup, name="db-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def _warmup(self):
+        delay = DB_CONNECT_BACKOFF
+        attempt = 0
+        while not self.connect():
+            attempt += 1
+            if not DATABASE_URL or (DB_CONNECT_RETRIES and attempt >= DB_CONNECT_RETRIES):
+                print(f"БД недоступна, попытки прекращены: {self.last_error}")
+                return
+            print(f"БД недоступна ({self.last_error}), повтор через {delay} с")
+            time.sleep(delay)
+            delay = min(delay * 2, DB_CONNECT_BACKOFF_MAX)
+        print("БД подключена")
+
+    def after_fork(self):
+        """
+        Вызывается в дочернем процессе после fork: соединения пула родителя не используются
+        (но и не закрываются), фоновое подключение перезапускается, если БД еще не готова.
+        """
+        global _engine_lock
+        _engine_lock = threading.Lock()  # мог быть захвачен потоком родителя в момент fork
+        self._ready_lock = threading.Lock()
+        if engine is not None:
+            engine.dispose(close=False)
+        self.request_session.remove()
+        self._request_state = threading.local()
+        if not self.is_ready():
+            self.start_warmup()
 
     def create_tables(self):
-        """Создает все таблицы в базе данных"""
+        """Создает недостающие таблицы и обновляет существующие"""
         try:
             Base.metadata.create_all(self.engine)
             print("Таблицы успешно созданы")
-            return True
+            return self.upgrade_tables()
         except SQLAlchemyError as e:
             print(f"Ошибка при создании таблиц: {e}")
             return False
 
+    def upgrade_tables(self):
+        """
+        Добавляет в существующие таблицы колонки и индексы, появившиеся в моделях после их создания;
+        таблицы, которых еще нет, пропускаются (их создает create_tables). True если обновление прошло
+        """
+        try:
+            inspector = sa_inspect(self.engine)
+            tables = set(inspector.get_table_names())
+            with self.engine.begin() as connection:
+                if 'employees' in tables:
+                    columns = [column['name'] for column in inspector.get_columns('employees')]
+                    if 'surname_normalized' not in columns:
+                        connection.execute(text("ALTER TABLE employees ADD COLUMN surname_normalized VARCHAR(100)"))
+                        # нормализуем в python: LOWER в SQLite не понимает кириллицу
+                        rows = connection.execute(text("SELECT id, surname FROM employees")).fetchall()
+                        if rows:
+                            connection.execute(text("UPDATE employees SET surname_normalized = :value WHERE id = :id"),
+                                               [{'id': row[0], 'value': normalize_surname(row[1])} for row in rows])
+                        print("Добавлена колонка employees.surname_normalized")
+                    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_employees_surname_normalized "
+                                            "ON employees (surname_normalized)"))
+                    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_employees_team_number "
+                                            "ON employees (team_number)"))
+
+                if 'licenses' in tables:
+                    license_columns = [column['name'] for column in inspector.get_columns('licenses')]
+                    if 'license_number' not in license_columns:
+                        connection.execute(text("ALTER TABLE licenses ADD COLUMN license_number VARCHAR(100)"))
+                        print("Добавлена колонка licenses.license_number")
+                    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_licenses_license_number "
+                                            "ON licenses (license_number)"))
+
+                if 'instruments' in tables:
+                    instrument_columns = [column['name'] for column in inspector.get_columns('instruments')]
+                    if 'valid_until_raw' not in instrument_columns:
+                        # старые строки выводят разобранную дату, пока приборы бригады не перезаписаны
+                        connection.execute(text("ALTER TABLE instruments ADD COLUMN valid_until_raw VARCHAR(100)"))
+                        print("Добавлена колонка instruments.valid_until_raw")
+            return True
+        except SQLAlchemyError as e:
+            self.last_error = str(e)
+            print(f"Ошибка при обновлении таблиц: {e}")
+            return False
+
     def delete_tables(self):
         try:
             Base.metadata.drop_all(self.engine, checkfirst="positions")
@@ -98,10 +399,38 @@ class DatabaseManager:
             print(f"Ошибка удаления: {e}")
             return False
 
+    def begin_request(self):
+        """Начало запроса: дальше все методы работают в одной сессии"""
+        self._request_state.active = True
+
+    def end_request(self):
+        """Конец запроса: закрывает сессию запроса и возвращает соединение в пул"""
+        self._request_state.active = False
+        self.request_session.remove()
+
+    @contextmanager
+    def request_scope(self):
+        """Сессия на время блока with (для кода вне Flask-запроса)"""
+        self.begin_request()
+        try:
+            yield self.request_session()
+        finally:
+            self.end_request()
+
+    def in_request(self):
+        return getattr(self._request_state, 'active', False)
+
     def get_session(self):
         """Возвращает сессию для работы с базой данных"""
+        if self.in_request():
+            return self.request_session()
         return self.SessionLocal()
 
+    def close_session(self, session):
+        """Закрывает сессию, если она не принадлежит текущему запросу"""
+        if not self.in_request():
+            session.close()
+
     def add_employee(self, name, surname, team_number, license_name, lastname=None, instrument_table = None, position="Специалист НК II уровня", license_number="NONE"):
         """Добавляет нового сотрудника"""
         session = self.get_session()
@@ -127,7 +456,7 @@ class DatabaseManager:
             print(f"Ошибка при добавлении сотрудника: {e}")
             return None
         finally:
-            session.close()
+            self.close_session(session)
 
     def add_license(self, license_number, license, license_end_date):
         """Добавляет позицию для сотрудника"""
@@ -148,8 +477,110 @@ class DatabaseManager:
             session.rollback()
             print(f"Ошибка при добавлении позиции: {e}")
             return None
+        finally:
+            self.close_session(session)
+
+    def import_from_excel(self, file_path, batch_size=IMPORT_BATCH_SIZE):
+        """
+        Массовый импорт сотрудников и удостоверений из xlsx.
+
+        Лист "employees" (или "Сотрудники"): surname, name, lastname, team_number,
+        position, license, license_number, instrument_table. Лист "licenses"
+        (или "Удостоверения"): license_number, license, license_end_date.
+        Заголовки можно писать по-русски (см. IMPORT_COLUMNS). Существующие
+        сотрудники (фамилия + имя) и удостоверения (номер + область) обновляются,
+        остальные добавляются пачками по batch_size строк, один commit на пачку.
+        """
+        import pandas as pd
+
+        sheets = pd.read_excel(file_path, sheet_name=None, dtype=str, engine='openpyxl')
+        summary = {}
+        for model, sheet_names in ((Employee, ('employees', 'Сотрудники')), (License, ('licenses', 'Удостоверения'))):
+            df = next((sheets[name] for name in sheet_names if name in sheets), None)
+            if df is None:
+                continue
+            df = df.rename(columns=lambda column: IMPORT_COLUMNS.get(str(column).strip(), str(column).strip()))
+            rows = [{key: value.strip() for key, value in row.items() if isinstance(value, str) and value.strip()}
+                    for row in df.to_dict('records')]
+            summary[model.__tablename__] = self._bulk_upsert(model, rows, batch_size)
+
+        for table_name, counts in summary.items():
+            print(f"{table_name}: добавлено {counts['added']}, обновлено {counts['updated']}, "
+                  f"пропущено {counts['skipped']}")
+        return summary
+
+    def _bulk_upsert(self, model, rows, batch_size):
+        counts = {'added': 0, 'updated': 0, 'skipped': 0}
+        session = self.SessionLocal()
+        try:
+            if model is Employee:
+                existing = {(surname_normalized, name): employee_id for employee_id, surname_normalized, name
+                            in session.query(Employee.id, Employee.surname_normalized, Employee.name)}
+            else:
+                existing = {(license_number, license): license_id for license_id, license_number, license
+                            in session.query(License.id, License.license_number, License.license)}
+
+            # повторы одной записи внутри файла сливаются: последние значения колонок побеждают
+            pending_inserts, pending_updates = {}, {}
+            for row in rows:
+                mapping = self._import_mapping(model, row)
+                if mapping is None:
+                    counts['skipped'] += 1
+                    continue
+                if model is Employee:
+                    key = (mapping['surname_normalized'], mapping['name'])
+                else:
+                    key = (mapping['license_number'], mapping['license'])
+                if key in existing:
+                    # обновляются только колонки, которые есть в файле
+                    pending_updates.setdefault(existing[key], {'id': existing[key]}).update(mapping)
+                else:
+                    pending_inserts.setdefault(key, dict(IMPORT_DEFAULTS.get(model.__tablename__, {}))).update(mapping)
+            inserts, updates = list(pending_inserts.values()), list(pending_updates.values())
+
+            for start in range(0, len(inserts), batch_size):
+                batch = inserts[start:start + batch_size]
+                session.bulk_insert_mappings(model, batch)
+                session.commit()
+                counts['added'] += len(batch)
+            for start in range(0, len(updates), batch_size):
+                batch = updates[start:start + batch_size]
+                session.bulk_update_mappings(model, batch)
+                session.commit()
+                counts['updated'] += len(batch)
+        except SQLAlchemyError as e:
+            session.rollback()
+            print(f"Ошибка при импорте {model.__tablename__}: {e}")
         finally:
             session.close()
+        return counts
+
+    @staticmethod
+    def _import_mapping(model, row):
+        """
+        Строка листа -> словарь колонок модели, None если не хватает обязательных полей.
+        Необязательные колонки попадают в словарь, только если они заполнены в строке
+        """
+        try:
+            if model is Employee:
+                mapping = {
+                    'surname': row['surname'],
+                    'surname_normalized': normalize_surname(row['surname']),
+                    'name': row['name'],
+                    'team_number': int(float(row['team_number'])),
+                    'license': row['license'],
+                }
+                mapping.update({column: row[column] for column in ('lastname', 'position', 'license_number',
+                                                                   'instrument_table') if column in row})
+                return mapping
+            return {
+                'license_number': row['license_number'],
+                'license': row['license'],
+                'license_end_date': datetime.fromisoformat(row['license_end_date'][:10])
+                if '-' in row['license_end_date'] else datetime.strptime(row['license_end_date'], "%d.%m.%Y"),
+            }
+        except (KeyError, ValueError):
+            return None
 
     def get_all_employees(self):
         """Получает всех сотрудников"""
@@ -161,7 +592,213 @@ class DatabaseManager:
             print(f"Ошибка при получении сотрудников: {e}")
             return []
         finally:
-            session.close()
+            self.close_session(session)
+
+    def get_employee(self, employee_id):
+        """Получает сотрудника по id"""
+        session = self.get_session()
+        try:
+            return session.query(Employee).filter(Employee.id == employee_id).first()
+        except SQLAlchemyError as e:
+            print(f"Ошибка при получении сотрудника: {e}")
+            return None
+        finally:
+            self.close_session(session)
+
+    def get_employees_by_surname(self, surname):
+        """Получает сотрудников по фамилии (без учета регистра и пробелов)"""
+        session = self.get_session()
+        try:
+            return session.query(Employee) \
+                .filter(Employee.surname_normalized == normalize_surname(surname)) \
+                .order_by(Employee.id) \
+                .all()
+        except SQLAlchemyError as e:
+            print(f"Ошибка при получении сотрудников: {e}")
+            return []
+        finally:
+            self.close_session(session)
+
+    def get_team(self, team_number):
+        """Получает всех сотрудников бригады"""
+        session = self.get_session()
+        try:
+            return session.query(Employee) \
+                .filter(Employee.team_number == team_number) \
+                .order_by(Employee.id) \
+                .all()
+        except SQLAlchemyError as e:
+            print(f"Ошибка при получении бригады: {e}")
+            return []
+        finally:
+            self.close_session(session)
+
+    def get_team_by_leader_surname(self, surname):
+        """
+        Находит руководителя по фамилии и остальных членов его бригады одним запросом.
+        Возвращает (leader, [члены бригады без руководителя]), если не найден - (None, [])
+        """
+        session = self.get_session()
+        try:
+            key = normalize_surname(surname)
+            leader_alias = aliased(Employee)
+            members = session.query(Employee) \
+                .join(leader_alias, leader_alias.team_number == Employee.team_number) \
+                .filter(leader_alias.surname_normalized == key) \
+                .order_by(Employee.id) \
+                .all()
+            leader = next((member for member in members if member.surname_normalized == key), None)
+            if leader is None:
+                return None, []
+            team = [member for member in members
+                    if member.team_number == leader.team_number and member.id != leader.id]
+            return leader, team
+        except SQLAlchemyError as e:
+            print(f"Ошибка при получении бригады: {e}")
+            self.connection_lost(e)
+            return None, []
+        finally:
+            self.close_session(session)
+
+    def get_teams(self):
+        """
+        Список бригад одним запросом: состав и количество действующих удостоверений.
+        Возвращает [{'team_number', 'members': [ФИО], 'valid_licenses'}] по номеру бригады,
+        None при ошибке БД (чтобы пустой список не попал в кэш)
+        """
+        session = self.get_session()
+        try:
+            rows = session.query(Employee.team_number, Employee.surname, Employee.name, Employee.lastname,
+                                 func.count(License.id)) \
+                .outerjoin(License, and_(License.license_number == Employee.license_number,
+                                         License.license_end_date >= datetime.now())) \
+                .group_by(Employee.id, Employee.team_number, Employee.surname, Employee.name, Employee.lastname) \
+                .order_by(Employee.team_number, Employee.id) \
+                .all()
+            teams = {}
+            for team_number, surname, name, lastname, valid_licenses in rows:
+                team = teams.setdefault(team_number, {'team_number': team_number, 'members': [], 'valid_licenses': 0})
+                team['members'].append(f"{surname} {name} {lastname or ''}".strip())
+                team['valid_licenses'] += valid_licenses
+            return list(teams.values())
+        except SQLAlchemyError as e:
+            print(f"Ошибка при получении бригад: {e}")
+            self.connection_lost(e)
+            return None
+        finally:
+            self.close_session(session)
+
+    def get_team_instruments(self, team_number):
+        """Получает приборы бригады по порядку строк таблицы"""
+        session = self.get_session()
+        try:
+            return session.query(Instrument) \
+                .filter(Instrument.team_number == team_number) \
+                .order_by(Instrument.slot) \
+                .all()
+        except SQLAlchemyError as e:
+            print(f"Ошибка при получении приборов: {e}")
+            self.connection_lost(e)
+            return []
+        finally:
+            self.close_session(session)
+
+    def set_team_instruments(self, team_number, instruments, layout=None):
+        """
+        Заменяет приборы бригады списком словарей (slot, kind, model, serial, certificate, valid_until).
+        Сохраненные строки приложений бригады сбрасываются, а если передана раскладка
+        шаблона layout = instruments.get_layout(...), сразу пересчитываются.
+        """
+        session = self.get_session()
+        try:
+            session.query(Instrument).filter(Instrument.team_number == team_number).delete()
+            session.query(TeamPrilojenie).filter(TeamPrilojenie.team_number == team_number).delete()
+            session.bulk_insert_mappings(Instrument, [dict(instrument, team_number=team_number)
+                                                      for instrument in instruments])
+            if layout is not None:
+                import instruments as instruments_module
+
+                layout_cells, layout_key = layout
+                team_instruments = session.query(Instrument) \
+                    .filter(Instrument.team_number == team_number) \
+                    .all()
+                prilojenie = instruments_module.build_prilojenie(
+                    instruments_module.instrument_cells(team_instruments, layout_cells))
+                session.add(TeamPrilojenie(team_number=team_number, layout_key=layout_key,
+                                           data=json.dumps(prilojenie, ensure_ascii=False)))
+            session.commit()
+            print(f"Приборы бригады {team_number} сохранены: {len(instruments)}")
+            return True
+        except SQLAlchemyError as e:
+            session.rollback()
+            print(f"Ошибка при сохранении приборов: {e}")
+            return False
+        finally:
+            self.close_session(session)
+
+    def get_team_prilojenie(self, team_number, layout_key):
+        """Сохраненные строки приложений бригады или None, если их нет или шаблон сменился"""
+        session = self.get_session()
+        try:
+            row = session.query(TeamPrilojenie).filter(TeamPrilojenie.team_number == team_number).first()
+            if row is None or row.layout_key != layout_key:
+                return None
+            return json.loads(row.data)
+        except SQLAlchemyError as e:
+            print(f"Ошибка при получении строк приложений: {e}")
+            self.connection_lost(e)
+            return None
+        finally:
+            self.close_session(session)
+
+    def save_team_prilojenie(self, team_number, layout_key, prilojenie):
+        """Сохраняет строки приложений бригады"""
+        session = self.get_session()
+        try:
+            session.merge(TeamPrilojenie(team_number=team_number, layout_key=layout_key,
+                                         data=json.dumps(prilojenie, ensure_ascii=False)))
+            session.commit()
+            return True
+        except SQLAlchemyError as e:
+            session.rollback()
+            print(f"Ошибка при сохранении строк приложений: {e}")
+            return False
+        finally:
+            self.close_session(session)
+
+    def get_expiring_instruments(self, date_from, date_to):
+        """Приборы, у которых поверка заканчивается в [date_from, date_to)"""
+        session = self.get_session()
+        try:
+            return session.query(Instrument) \
+                .filter(Instrument.valid_until >= date_from, Instrument.valid_until < date_to) \
+                .order_by(Instrument.valid_until, Instrument.team_number) \
+                .all()
+        except SQLAlchemyError as e:
+            print(f"Ошибка при получении приборов: {e}")
+            self.connection_lost(e)
+            return []
+        finally:
+            self.close_session(session)
+
+    def migrate_instrument_tables(self, layout_cells=None):
+        """
+        Переносит приборы из XML Employee.instrument_table в таблицу instruments.
+        layout_cells - тексты таблицы приборов шаблона: ее строки заголовков не переносятся
+        """
+        from docx import Document
+        from docx.oxml import parse_xml
+        from docx.table import Table
+        import instruments
+
+        body = Document().element.body
+        for employee in self.get_all_employees():
+            if not employee.instrument_table:
+                continue
+            table = Table(parse_xml(employee.instrument_table), body)
+            self.set_team_instruments(employee.team_number,
+                                      instruments.instruments_from_cells(instruments.table_cells(table),
+                                                                         layout_cells))
 
     def print_all_employees(self):
         session = self.get_session()
@@ -173,7 +810,7 @@ class DatabaseManager:
             print(f"Ошибка при получении сотрудников: {e}")
             return []
         finally:
-            session.close()
+            self.close_session(session)
 
     def get_employee_with_licenses(self, employee_id):
         """Получает сотрудника с его позициями"""
@@ -190,7 +827,7 @@ class DatabaseManager:
             print(f"Ошибка при получении сотрудника: {e}")
             return None
         finally:
-            session.close()
+            self.close_session(session)
 
     def get_employee_with_licenses_alternative(self, employee_id):
         """Альтернативный способ получения сотрудника с позициями"""
@@ -205,7 +842,7 @@ class DatabaseManager:
             print(f"Ошибка при получении сотрудника: {e}")
             return None
         finally:
-            session.close()
+            self.close_session(session)
 
     def get_licenses_by_employee(self, employee_id):
         """Получает все позиции сотрудника"""
@@ -219,7 +856,7 @@ class DatabaseManager:
             print(f"Ошибка при получении позиций: {e}")
             return []
         finally:
-            session.close()
+            self.close_session(session)
 
     def get_all_employees_with_licenses(self):
         """Получает всех сотрудников с их позициями"""
@@ -234,7 +871,7 @@ class DatabaseManager:
             print(f"Ошибка при получении сотрудников: {e}")
             return []
         finally:
-            session.close()
+            self.close_session(session)
 
     def update_employee(self, employee_id, name, surname, team_number, lastname=None):
         """Обновляет данные сотрудника"""
@@ -259,7 +896,7 @@ class DatabaseManager:
             print(f"Ошибка при обновлении сотрудника: {e}")
             return None
         finally:
-            session.close()
+            self.close_session(session)
 
     def delete_employee(self, employee_id):
         """Удаляет сотрудника"""
@@ -276,7 +913,7 @@ class DatabaseManager:
             print(f"Ошибка при удалении сотрудника: {e}")
             return False
         finally:
-            session.close()
+            self.close_session(session)
 
     def raw_sql_query(self, sql_query, params=None):
         """Выполняет сырой SQL запрос"""
@@ -292,18 +929,341 @@ class DatabaseManager:
             session.rollback()
             print(f"Ошибка при выполнении SQL запроса: {e}")
             return None
+        finally:
+            self.close_session(session)
+
+
+
+
+
+class CachedDatabaseManager(DatabaseManager):
+    """
+    DatabaseManager с кэшем сотрудников и приборов бригад в памяти процесса.
+
+    Все сотрудники читаются одним запросом и раскладываются по id, нормализованной
+    фамилии и номеру бригады, приборы и строки приложений - одним запросом по номеру
+    бригады. Кэш живет
+    ttl секунд и сбрасывается при изменении данных этим же процессом (add_employee,
+    update_employee, delete_employee, set_team_instruments, импорт); save_team_prilojenie
+    сразу обновляет кэш строк приложений.
+    """
+
+    def __init__(self, ttl=DB_CACHE_TTL):
+        super().__init__()
+        self.ttl = ttl
+        self._cache_lock = threading.Lock()
+        self._cache = None
+        self._cache_loaded_at = 0.0
+        self._tables_cache = {}  # имя -> (время загрузки, данные) для кэшей кроме сотрудников
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.data_version = 0  # растет при каждом изменении сотрудников этим процессом
+
+    def after_fork(self):
+        # загруженный до fork кэш остается общим (copy-on-write), блокировка - своя у процесса
+        self._cache_lock = threading.Lock()
+        super().after_fork()
+
+    def invalidate_cache(self):
+        with self._cache_lock:
+            self._cache = None
+            self._tables_cache = {}
+            self.data_version += 1
+
+    def _cached_table(self, name, load):
+        """Данные load(session), загруженные одним запросом и живущие ttl; None если БД недоступна"""
+        with self._cache_lock:
+            entry = self._tables_cache.get(name)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self.cache_hits += 1
+                return entry[1]
+            self.cache_misses += 1
+
+            session = self.SessionLocal()
+            try:
+                data = load(session)
+            except SQLAlchemyError as e:
+                print(f"Ошибка при загрузке кэша {name}: {e}")
+                self.connection_lost(e)
+                return None
+            finally:
+                session.close()
+            self._tables_cache[name] = (time.monotonic(), data)
+            return data
+
+    @staticmethod
+    def _load_instruments(session):
+        by_team = defaultdict(list)
+        for instrument in session.query(Instrument).order_by(Instrument.team_number, Instrument.slot):
+            by_team[instrument.team_number].append(instrument)
+        return by_team
+
+    @staticmethod
+    def _load_prilojenie(session):
+        return {row.team_number: (row.layout_key, json.loads(row.data)) for row in session.query(TeamPrilojenie)}
+
+    def cache_stats(self):
+        return {
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'loaded': self._cache is not None,
+            'age': round(time.monotonic() - self._cache_loaded_at, 3) if self._cache is not None else None,
+            'ttl': self.ttl,
+        }
+
+    def _uncached(self, name, empty, *args):
+        """
+        Запрос мимо незагрузившегося кэша. Если кэш не загрузился из-за потери соединения
+        (connection_lost), вторая попытка не делается: сразу пустой результат, и вызывающий
+        берет данные из снимка, а не ждет пропавшую БД еще раз
+        """
+        if not self.is_ready():
+            return empty
+        return getattr(super(), name)(*args)
+
+    def _load_employees(self):
+        # отдельная сессия: объекты остаются загруженными и не зависят от сессии запроса
+        session = self.SessionLocal()
+        try:
+            return session.query(Employee).order_by(Employee.id).all()
+        except SQLAlchemyError as e:
+            print(f"Ошибка при загрузке кэша сотрудников: {e}")
+            self.connection_lost(e)
+            return None
         finally:
             session.close()
 
+    def _employees_cache(self):
+        with self._cache_lock:
+            if self._cache is not None and time.monotonic() - self._cache_loaded_at < self.ttl:
+                self.cache_hits += 1
+                return self._cache
+            self.cache_misses += 1
+
+            employees = self._load_employees()
+            if employees is None:
+                return None
+            cache = {
+                'all': employees,
+                'by_id': {},
+                'by_surname': defaultdict(list),
+                'by_team': defaultdict(list),
+            }
+            for employee in employees:
+                cache['by_id'][employee.id] = employee
+                cache['by_surname'][employee.surname_normalized].append(employee)
+                cache['by_team'][employee.team_number].append(employee)
+            self._cache = cache
+            self._cache_loaded_at = time.monotonic()
+            return cache
+
+    def get_all_employees(self):
+        cache = self._employees_cache()
+        if cache is None:
+            return self._uncached('get_all_employees', [])
+        return list(cache['all'])
+
+    def get_employee(self, employee_id):
+        cache = self._employees_cache()
+        if cache is None:
+            return self._uncached('get_employee', None, employee_id)
+        return cache['by_id'].get(employee_id)
+
+    def get_employees_by_surname(self, surname):
+        cache = self._employees_cache()
+        if cache is None:
+            return self._uncached('get_employees_by_surname', [], surname)
+        return list(cache['by_surname'].get(normalize_surname(surname), []))
+
+    def get_team(self, team_number):
+        cache = self._employees_cache()
+        if cache is None:
+            return self._uncached('get_team', [], team_number)
+        return list(cache['by_team'].get(team_number, []))
+
+    def get_team_by_leader_surname(self, surname):
+        cache = self._employees_cache()
+        if cache is None:
+            return self._uncached('get_team_by_leader_surname', (None, []), surname)
+        leaders = cache['by_surname'].get(normalize_surname(surname))
+        if not leaders:
+            return None, []
+        leader = leaders[0]
+        team = [member for member in cache['by_team'][leader.team_number] if member.id != leader.id]
+        return leader, team
+
+    def get_team_instruments(self, team_number):
+        by_team = self._cached_table('instruments', self._load_instruments)
+        if by_team is None:
+            return self._uncached('get_team_instruments', [], team_number)
+        return list(by_team.get(team_number, []))
+
+    def set_team_instruments(self, *args, **kwargs):
+        try:
+            return super().set_team_instruments(*args, **kwargs)
+        finally:
+            self.invalidate_cache()
+
+    def get_team_prilojenie(self, team_number, layout_key):
+        by_team = self._cached_table('prilojenie', self._load_prilojenie)
+        if by_team is None:
+            return self._uncached('get_team_prilojenie', None, team_number, layout_key)
+        saved = by_team.get(team_number)
+        if saved is None or saved[0] != layout_key:
+            return None
+        return dict(saved[1])
+
+    def save_team_prilojenie(self, team_number, layout_key, prilojenie):
+        saved = super().save_team_prilojenie(team_number, layout_key, prilojenie)
+        with self._cache_lock:
+            entry = self._tables_cache.get('prilojenie')
+            if entry is not None:
+                if saved:
+                    entry[1][team_number] = (layout_key, dict(prilojenie))
+                else:
+                    del self._tables_cache['prilojenie']
+        return saved
+
+    def add_employee(self, *args, **kwargs):
+        try:
+            return super().add_employee(*args, **kwargs)
+        finally:
+            self.invalidate_cache()
+
+    def update_employee(self, *args, **kwargs):
+        try:
+            return super().update_employee(*args, **kwargs)
+        finally:
+            self.invalidate_cache()
+
+    def delete_employee(self, *args, **kwargs):
+        try:
+            return super().delete_employee(*args, **kwargs)
+        finally:
+            self.invalidate_cache()
 
+    def add_license(self, *args, **kwargs):
+        try:
+            return super().add_license(*args, **kwargs)
+        finally:
+            self.invalidate_cache()
 
+    def import_from_excel(self, *args, **kwargs):
+        try:
+            return super().import_from_excel(*args, **kwargs)
+        finally:
+            self.invalidate_cache()
 
 
+class AsyncDatabaseManager:
+    """
+    Асинхронные запросы на чтение для FastAPI (main.py) через sqlalchemy.ext.asyncio.
+    Движок создается при первом запросе, чтобы синхронному коду не нужен был async-драйвер.
+    Если async-драйвер не установлен, конструктор бросает ValueError, как и без DATABASE_URL.
+    """
+
+    def __init__(self, url=None):
+        self.url = url or ASYNC_DATABASE_URL
+        if not self.url:
+            raise ValueError("EXTERNAL_DATABASE_URL не найден в переменных окружения")
+        try:
+            make_url(self.url).get_dialect().import_dbapi()
+        except (ImportError, SQLAlchemyError) as e:  # например, не установлен asyncpg
+            raise ValueError(f"async-драйвер для {self.url.split('://', 1)[0]} недоступен: {e}")
+        self.engine = None
+        self.SessionLocal = None
+
+    def get_session(self):
+        if self.engine is None:
+            from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+            options = dict(pool_pre_ping=DB_POOL_PRE_PING, pool_recycle=DB_POOL_RECYCLE)
+            if not self.url.startswith('sqlite'):
+                options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+            self.engine = create_async_engine(self.url, **options)
+            if self.url.startswith('sqlite'):
+                event.listen(self.engine.sync_engine, 'connect', set_sqlite_pragmas)
+            self.SessionLocal = async_sessionmaker(self.engine, expire_on_commit=False)
+        return self.SessionLocal()
+
+    async def close(self):
+        if self.engine is not None:
+            await self.engine.dispose()
+
+    async def _all(self, query, error_message):
+        try:
+            async with self.get_session() as session:
+                return list((await session.execute(query)).scalars().all())
+        except (SQLAlchemyError, ImportError) as e:  # в том числе ошибка создания движка
+            print(f"{error_message}: {e}")
+            return []
+
+    async def get_all_employees(self):
+        """Получает всех сотрудников"""
+        return await self._all(select(Employee).order_by(Employee.id), "Ошибка при получении сотрудников")
+
+    async def get_employee(self, employee_id):
+        """Получает сотрудника по id"""
+        employees = await self._all(select(Employee).where(Employee.id == employee_id),
+                                    "Ошибка при получении сотрудника")
+        return employees[0] if employees else None
+
+    async def get_team(self, team_number):
+        """Получает всех сотрудников бригады"""
+        return await self._all(select(Employee).where(Employee.team_number == team_number).order_by(Employee.id),
+                               "Ошибка при получении бригады")
+
+    async def get_team_by_leader_surname(self, surname):
+        """Руководитель по фамилии и остальные члены его бригады одним запросом, как в DatabaseManager"""
+        key = normalize_surname(surname)
+        leader_alias = aliased(Employee)
+        members = await self._all(
+            select(Employee)
+            .join(leader_alias, leader_alias.team_number == Employee.team_number)
+            .where(leader_alias.surname_normalized == key)
+            .order_by(Employee.id),
+            "Ошибка при получении бригады")
+        leader = next((member for member in members if member.surname_normalized == key), None)
+        if leader is None:
+            return None, []
+        return leader, [member for member in members
+                        if member.team_number == leader.team_number and member.id != leader.id]
+
+    async def get_licenses(self, license_number):
+        """Получает удостоверения по номеру"""
+        return await self._all(select(License).where(License.license_number == license_number)
+                               .order_by(License.license_end_date),
+                               "Ошибка при получении удостоверений")
+
+    async def get_team_instruments(self, team_number):
+        """Получает приборы бригады по порядку строк таблицы"""
+        return await self._all(select(Instrument).where(Instrument.team_number == team_number)
+                               .order_by(Instrument.slot),
+                               "Ошибка при получении приборов")
+
 
 # Пример использования
 if __name__ == "__main__":
 
     db = DatabaseManager()
+
+    # python db.py import staff.xlsx - массовый импорт сотрудников и удостоверений
+    if len(sys.argv) > 2 and sys.argv[1] == "import":
+        db.create_tables()
+        db.import_from_excel(sys.argv[2])
+        sys.exit(0)
+
+    # python db.py migrate_instruments - перенос приборов из Employee.instrument_table
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate_instruments":
+        db.create_tables()
+        try:
+            from another_try import get_instrument_layout
+            layout_cells = get_instrument_layout()[0]
+        except Exception as e:  # без шаблона пропускаются только объединенные строки заголовков
+            print(f"Не удалось прочитать таблицу приборов шаблона: {e}")
+            layout_cells = None
+        db.migrate_instrument_tables(layout_cells)
+        sys.exit(0)
     # print(db.print_all_employees())
     # print("-------------------------------")
     # print(db.get_licenses_by_employee(1)[0].get_info())
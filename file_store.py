@@ -0,0 +1,206 @@
+"""
+Хранилище сгенерированных отчетов и загруженных файлов с ограничением по месту на диске.
+
+Файлы лежат по хэшу содержимого (objects/ab/abcdef...), поэтому одинаковые файлы
+хранятся один раз. Для загруженных графиков это работает; сгенерированные .docx почти
+никогда не совпадают: в zip записывается время сохранения, а строки приложений содержат
+случайные значения, так что каждый отчет - отдельный объект и место ограничивает только очистка.
+Фоновая очистка удаляет файлы старше max_age и, если каталог больше бюджета, самые давно
+использованные (по mtime, который обновляется при выдаче). Файлы, записанные или выданные
+за последние STORE_GRACE секунд, не удаляются: put()/get() и удаление каждого файла очисткой
+идут под общей для процессов блокировкой, а перед удалением mtime проверяется заново, поэтому
+объект не пропадает между put() и отдачей send_file.
+"""
+import hashlib
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка только в пределах процесса
+    fcntl = None
+
+
+STORE_MAX_BYTES = int(os.getenv('STORE_MAX_MB', '2048')) * 1024 * 1024
+STORE_MAX_AGE = int(os.getenv('STORE_MAX_AGE_DAYS', '30')) * 24 * 3600
+STORE_CLEAN_INTERVAL = int(os.getenv('STORE_CLEAN_INTERVAL', '600'))  # секунды
+STORE_MIN_FREE_BYTES = int(os.getenv('STORE_MIN_FREE_MB', '200')) * 1024 * 1024  # свободное место на диске
+TEMP_MAX_AGE = 3600  # недописанные временные файлы старше часа удаляются
+STORE_GRACE = 300  # только что записанный или выданный файл не удаляется столько секунд
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+OBJECT_NAME_RE = re.compile(r'^[0-9a-f]{64}(\.[A-Za-z0-9]+)?$')
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FileStore:
+    def __init__(self, root, max_bytes=STORE_MAX_BYTES, max_age=STORE_MAX_AGE):
+        self.root = str(root)
+        self.objects_dir = os.path.join(self.root, 'objects')
+        self.tmp_dir = os.path.join(self.root, 'tmp')
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._evict_lock = threading.Lock()
+        self.lock_path = os.path.join(self.root, '.lock')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def temp_path(self, suffix=''):
+        """Путь для записи нового файла; затем он передается в put()"""
+        return os.path.join(self.tmp_dir, f"{uuid.uuid4().hex}{suffix}")
+
+    @contextmanager
+    def _lock(self):
+        """Блокировка хранилища для потоков процесса и для других воркеров"""
+        with self._evict_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.lock_path, 'a+') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def put(self, tmp_path, content_hash=None):
+        """
+        Переносит записанный файл в хранилище и возвращает его постоянный путь.
+        Если такой файл уже есть, временный удаляется, а существующий помечается использованным.
+        content_hash - sha256, если он уже посчитан при записи
+        """
+        content_hash = content_hash or file_sha256(tmp_path)
+        extension = os.path.splitext(tmp_path)[1]
+        object_dir = os.path.join(self.objects_dir, content_hash[:2])
+        object_path = os.path.join(object_dir, content_hash + extension)
+        with self._lock():
+            if os.path.exists(object_path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(object_dir, exist_ok=True)
+                os.replace(tmp_path, object_path)
+            self.touch(object_path)  # mtime нового файла - время записи, а не отдачи
+        return object_path
+
+    def get(self, name):
+        """Путь файла по имени объекта (хэш с расширением) или None; файл помечается использованным"""
+        if not OBJECT_NAME_RE.match(name or ''):
+            return None
+        path = os.path.join(self.objects_dir, name[:2], name)
+        with self._lock():
+            if not os.path.exists(path):
+                return None
+            self.touch(path)
+        return path
+
+    @staticmethod
+    def content_hash(path):
+        """Хэш содержимого по имени объекта, без чтения файла"""
+        return os.path.splitext(os.path.basename(path))[0]
+
+    def touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def reserve(self, nbytes=0):
+        """Перед записью: если на диске почти не осталось места, очищает хранилище сразу"""
+        if shutil.disk_usage(self.root).free < STORE_MIN_FREE_BYTES + nbytes:
+            print("Мало места на диске, очистка хранилища")
+            self.evict(target_bytes=self.max_bytes // 2)
+
+    def _files(self):
+        for root, _, files in os.walk(self.root):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                if path == self.lock_path:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:  # удален другим процессом
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def evict(self, target_bytes=None):
+        """
+        Удаляет старые файлы и самые давно использованные сверх бюджета; возвращает число удаленных.
+        Каталог обходится без блокировки, она берется только на удаление каждого файла,
+        так что put()/get() других запросов не ждут всю очистку
+        """
+        target_bytes = self.max_bytes if target_bytes is None else target_bytes
+        now = time.time()
+        removed = 0
+        kept = []
+        for path, size, mtime in self._files():
+            max_age = TEMP_MAX_AGE if path.startswith(self.tmp_dir + os.sep) else self.max_age
+            if now - mtime > max_age and self._remove_unused(path, mtime):
+                removed += 1
+            else:
+                kept.append((mtime, size, path))
+        total = sum(size for _, size, _ in kept)
+        kept.sort()
+        for mtime, size, path in kept:
+            if total <= target_bytes:
+                break
+            if path.startswith(self.tmp_dir + os.sep):
+                continue  # еще записывается
+            if now - mtime < STORE_GRACE:
+                break  # дальше только более свежие: их сейчас отдают клиентам
+            if self._remove_unused(path, mtime):
+                removed += 1
+                total -= size
+        return removed
+
+    def _remove_unused(self, path, mtime):
+        """Удаляет файл, если с обхода каталога его не записали и не выдали заново (mtime тот же)"""
+        with self._lock():
+            try:
+                if os.stat(path).st_mtime != mtime:
+                    return False
+            except FileNotFoundError:
+                return False
+            return self._remove(path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError as e:  # например, файл еще отдается клиенту на Windows
+            print(f"Не удалось удалить {path}: {e}")
+            return False
+
+    def after_fork(self):
+        """В новом воркере: блокировку мог держать поток очистки главного процесса в момент fork"""
+        self._evict_lock = threading.Lock()
+
+    def start_cleaner(self, interval=STORE_CLEAN_INTERVAL):
+        """Фоновая очистка каждые interval секунд"""
+        def run():
+            while True:
+                try:
+                    removed = self.evict()
+                    if removed:
+                        print(f"Хранилище {self.root}: удалено файлов {removed}")
+                except Exception as e:
+                    print(f"Ошибка очистки хранилища {self.root}: {e}")
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, name="store-cleaner", daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,270 @@
+"""
+Таблица средств измерений бригады и строки приложений, которые из нее собираются.
+
+Раскладка таблицы приборов (таблица "instruments" шаблона): каждый прибор занимает
+свою строку (slot), в столбце 1 заголовки групп, в столбцах 2-6 наименование,
+модель, заводской номер, срок поверки и номер свидетельства.
+"""
+import hashlib
+import json
+import os
+from datetime import datetime
+
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+
+
+KIND_COL = 2
+MODEL_COL = 3
+SERIAL_COL = 4
+VALID_UNTIL_COL = 5
+CERTIFICATE_COL = 6
+
+FIRST_SLOT = 2
+LAST_SLOT = 56
+
+# входит в хэш раскладки: при смене формата текстов сохраненные строки приложений пересчитываются
+CELLS_VERSION = 2
+
+
+def format_valid_until(valid_until, raw=None):
+    """
+    Текст срока поверки для отчета: исходный текст ячейки, если он сохранен (формат даты
+    или пометки как в таблице), иначе дата; разобранная дата нужна только для сортировки и проверок
+    """
+    if raw:
+        return raw
+    if valid_until is None:
+        return ''
+    return valid_until.strftime("%d.%m.%Y")
+
+
+def parse_valid_until(text):
+    """Дата из ячейки срока поверки, None если там не дата"""
+    text = (text or '').strip()
+    for date_format in ("%d.%m.%Y", "%d.%m.%y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(text, date_format)
+        except ValueError:
+            pass
+    return None
+
+
+def table_cells(table) -> dict[tuple[int, int], str]:
+    """Все тексты таблицы за один проход: {(строка, столбец): текст}"""
+    cells = table._cells  # python-docx пересчитывает сетку при каждом table.cell()
+    col_count = len(table._tbl.tblGrid.gridCol_lst)
+    return {(index // col_count, index % col_count): cell.text for index, cell in enumerate(cells)}
+
+
+_layout_cache = {}
+
+
+def get_layout(template_path, table):
+    """
+    Тексты таблицы приборов шаблона и их хэш; считается один раз на файл шаблона.
+    Хэш входит в ключ сохраненных строк приложений, чтобы смена шаблона их сбрасывала.
+    table - таблица или функция без аргументов, которая ее вернет (вызывается только без кэша).
+    """
+    key = (str(template_path), os.path.getmtime(template_path))
+    if key not in _layout_cache:
+        cells = table_cells(table() if callable(table) else table)
+        dump = json.dumps([CELLS_VERSION, sorted((list(position), text) for position, text in cells.items())],
+                          ensure_ascii=False)
+        _layout_cache[key] = (cells, hashlib.sha1(dump.encode('utf-8')).hexdigest())
+    return _layout_cache[key]
+
+
+def is_header_row(values: list[str], layout_values: list[str] = None) -> bool:
+    """
+    Строка заголовка, а не прибор: объединенная ячейка (python-docx повторяет ее текст
+    во всех столбцах) или та же строка заголовка, что и в таблице приборов шаблона
+    (тексты совпадают, а в столбце срока поверки не дата)
+    """
+    filled = [value for value in values if value]
+    if len(filled) > 1 and len(set(filled)) == 1:
+        return True
+    return (layout_values is not None and values == layout_values
+            and parse_valid_until(layout_values[VALID_UNTIL_COL - KIND_COL]) is None)
+
+
+def instruments_from_cells(cells: dict[tuple[int, int], str],
+                           layout_cells: dict[tuple[int, int], str] = None) -> list[dict]:
+    """
+    Приборы из текстов таблицы (для переноса из старого XML в таблицу instruments).
+    Строки заголовков пропускаются; layout_cells - тексты таблицы приборов шаблона (get_layout)
+    """
+    instruments = []
+    for slot in range(FIRST_SLOT, LAST_SLOT + 1):
+        values = [cells.get((slot, col), '').strip() for col in range(KIND_COL, CERTIFICATE_COL + 1)]
+        if not any(values):
+            continue
+        layout_values = None
+        if layout_cells is not None:
+            layout_values = [layout_cells.get((slot, col), '').strip() for col in range(KIND_COL, CERTIFICATE_COL + 1)]
+        if is_header_row(values, layout_values):
+            continue
+        kind, model, serial, valid_until, certificate = values
+        instruments.append({
+            'slot': slot,
+            'kind': kind,
+            'model': model,
+            'serial': serial,
+            'valid_until': parse_valid_until(valid_until),
+            'valid_until_raw': valid_until,
+            'certificate': certificate,
+        })
+    return instruments
+
+
+def instrument_cells(instruments, layout_cells: dict[tuple[int, int], str] = None) -> dict[tuple[int, int], str]:
+    """Тексты таблицы из записей приборов поверх раскладки шаблона (заголовки групп и т.п.)"""
+    cells = dict(layout_cells or {})
+    for instrument in instruments:
+        cells[(instrument.slot, KIND_COL)] = instrument.kind or ''
+        cells[(instrument.slot, MODEL_COL)] = instrument.model or ''
+        cells[(instrument.slot, SERIAL_COL)] = instrument.serial or ''
+        cells[(instrument.slot, VALID_UNTIL_COL)] = format_valid_until(instrument.valid_until,
+                                                                       instrument.valid_until_raw)
+        cells[(instrument.slot, CERTIFICATE_COL)] = instrument.certificate or ''
+    return cells
+
+
+def set_cell_text(cell, text: str):
+    """Пишет текст в ячейку, сохраняя оформление первого абзаца и первого run"""
+    tc = cell._tc
+    paragraphs = tc.p_lst
+    p = paragraphs[0]
+    for extra in paragraphs[1:]:
+        tc.remove(extra)
+    runs = p.r_lst
+    if runs:
+        r = runs[0]
+        for extra in runs[1:]:
+            p.remove(extra)
+        for child in list(r):
+            if child.tag != qn('w:rPr'):
+                r.remove(child)
+    else:
+        r = OxmlElement('w:r')
+        p.append(r)
+    t = OxmlElement('w:t')
+    t.text = text
+    t.set(qn('xml:space'), 'preserve')
+    r.append(t)
+
+
+def fill_instrument_table(table, instruments):
+    """Заполняет таблицу приборов шаблона записями бригады"""
+    cells = table._cells
+    col_count = len(table._tbl.tblGrid.gridCol_lst)
+    for (row, col), text in instrument_cells(instruments).items():
+        set_cell_text(cells[row * col_count + col], text)
+
+
+def build_prilojenie(cells: dict[tuple[int, int], str]) -> dict[str, str]:
+    """Строки приборов, свидетельств и образцов для приложений 5-14"""
+    def cell(row, col):
+        return cells.get((row, col), '')
+
+    row_data = []
+    for i in range(5):
+        row_data.append(cell(52, 2 + i).strip())
+    prilojenie_5 = [f"{row_data[0]} {row_data[1]},\n зав. № {row_data[2]}", f"№ {row_data[4]} до {row_data[3]}"]
+
+    row_data = []
+    for i in range(5):
+        row_data.append(cell(51, 2 + i).strip())
+    prilojenie_6 = [
+        f"{row_data[0]} {row_data[1]}, зав. № {row_data[2]}, {cell(56, 2).strip()}"
+        f"\n(2 шт.), {cell(56, 6).lower().strip()}.",
+        f"№ {row_data[4]} до {row_data[3]}"]
+
+    row_data = []
+    row_data.append([cell(2, 1).strip()])
+    for j in range(2, 11):
+        row_data.append([])
+        for i in range(4):
+            row_data[j - 1].append(cell(j, 2 + i).strip())
+
+    prilojenie_10 = [f"{row_data.pop(0)[0]}:\n"]
+
+    for row_instr in row_data:
+        prilojenie_10[0] += f" {row_instr[0]} {row_instr[1]} зав. № {row_instr[2]};"
+
+    prilojenie_10.append("")
+    prilojenie_10[1] += f"№{cell(2, 6).strip()} до {cell(2, 5).strip()};"
+
+    for row_instr in (11, 12, 13, 46):
+        prilojenie_10[0] += f" {cell(row_instr, 2).strip()} {cell(row_instr, 3).strip()} зав. № {cell(row_instr, 4).strip()};"
+        prilojenie_10[1] += f" № {cell(row_instr, 6).strip()} до {cell(row_instr, 5).strip()};"
+
+    prilojenie_10.append("")
+    for row_instr in (15, 16, 17, 18):
+        prilojenie_10[2] += (f" {cell(row_instr, 3).strip()}"
+                             f" зав. № {cell(row_instr, 4).strip()}"
+                             f" свид. {cell(row_instr, 6).strip()}"
+                             f" до {cell(row_instr, 5).strip()}\n")
+    prilojenie_10[2] = prilojenie_10[2].strip()
+
+    for_insert_text = prilojenie_10[0].split(' ')
+    index_linear = for_insert_text.index('Линейка')
+    for_insert_text[index_linear + 2] = 'Л-300'  # заменяем 'мм' на 'Л-300'
+    for_insert_text[index_linear + 3] = '(' + for_insert_text[index_linear + 3] + ')'
+    prilojenie_10[0] = ' '.join(for_insert_text)
+
+    row_data = []
+    for i in range(5):
+        row_data.append(cell(20, 2 + i).strip())
+    prilojenie_11 = [f"{row_data[0]} {row_data[1]},\n заводской № {row_data[2]}",
+                     f"№ {row_data[4]} до {row_data[3]}", ""]
+
+    for row_instr in (28, 29, 31, 32, 33, 34, 35, 36, 37, 38, 39):
+        prilojenie_11[2] += (f"{cell(row_instr, 3).strip()}"
+                             f" зав. № {cell(row_instr, 4).strip()}"
+                             f" свид. № {cell(row_instr, 6).strip()}"
+                             f" до {cell(row_instr, 5).strip()};\n")
+    prilojenie_11[2] = prilojenie_11[2].strip()
+
+    row_data = []
+    for i in range(5):
+        row_data.append(cell(19, 2 + i).strip())
+    prilojenie_12 = [f"{row_data[0]} {row_data[1]} зав. № {row_data[2]}",
+                     f"№ {row_data[4]} до {row_data[3]}", ""]
+    row_data = []
+    for i in range(4):
+        row_data.append(cell(30, 3 + i).strip())
+    prilojenie_12[2] = f"{row_data[0]} зав. № {row_data[1]} свид. № {row_data[3]} до {row_data[2]};"
+
+    row_data = []
+    for i in range(5):
+        row_data.append(cell(21, 2 + i).strip())
+    prilojenie_13 = [f"{row_data[0]} {row_data[1]} № {row_data[2]}",
+                     f"№ {row_data[4]} до {row_data[3]}", ""]
+    row_data = []
+    for i in range(5):
+        row_data.append(cell(22, 2 + i).strip())
+    prilojenie_13[2] = f"{row_data[0]} {row_data[1]} № {row_data[2]}\n№ {row_data[4]} до {row_data[3]}"
+
+    prilojenie_14 = f"{cell(47, 2).strip()} {cell(47, 3).strip()} зав. №{cell(47, 4).strip()}"
+
+    return {
+        '{{control_instruments_5}}': prilojenie_5[0],
+        '{{control_instruments_6}}': prilojenie_6[0],
+        '{{control_instruments_10}}': prilojenie_10[0],
+        '{{control_instruments_11}}': prilojenie_11[0],
+        '{{control_instruments_12}}': prilojenie_12[0],
+        '{{control_instruments_13}}': prilojenie_13[0],
+        '{{control_instruments_14}}': prilojenie_14,
+        '{{verification_certificate_5}}': prilojenie_5[1],
+        '{{verification_certificate_6}}': prilojenie_6[1],
+        '{{verification_certificate_10}}': prilojenie_10[1],
+        '{{verification_certificate_11}}': prilojenie_11[1],
+        '{{verification_certificate_12}}': prilojenie_12[1],
+        '{{verification_certificate_13}}': prilojenie_13[1],
+
+        '{{standard_sample_10}}': prilojenie_10[2],
+        '{{standard_sample_12}}': prilojenie_12[2],
+        '{{SOP_11}}': prilojenie_11[2],
+        '{{hardness_measures_13}}': prilojenie_13[2]
+    }
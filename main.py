@@ -5,6 +5,7 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from typing import Optional
+import asyncio
 import os
 import io
 import uuid
@@ -41,6 +42,48 @@ UPLOAD_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
 STATIC_DIR.mkdir(exist_ok=True)
 
+# готовые документы: по хэшу содержимого, старые удаляются в фоне
+from file_store import FileStore
+output_store = FileStore(OUTPUT_DIR)
+output_store.start_cleaner()
+
+# Асинхронный доступ к БД, чтобы запросы не блокировали event loop
+try:
+    from db import AsyncDatabaseManager
+    async_db = AsyncDatabaseManager()
+except ValueError as e:  # DATABASE_URL не задан или не установлен async-драйвер: генерация без данных БД
+    print(f"БД недоступна: {e}")
+    async_db = None
+
+
+@app.on_event("shutdown")
+async def close_db():
+    if async_db is not None:
+        await async_db.close()
+
+
+async def get_team_replacements(leader_surname: Optional[str]) -> dict:
+    """Плейсхолдеры руководителя и члена бригады из БД"""
+    if async_db is None or not leader_surname:
+        return {}
+    leader, team = await async_db.get_team_by_leader_surname(leader_surname)
+    if leader is None:
+        return {}
+    replacements = {
+        '{{leader_full}}': f"{leader.surname} {leader.name} {leader.lastname or ''}".strip(),
+        '{{leader_position}}': leader.position,
+        '{{leader_license}}': leader.license,
+    }
+    if team:
+        worker = team[0]
+        replacements.update({
+            '{{worker_full}}': f"{worker.surname} {worker.name} {worker.lastname or ''}".strip(),
+            '{{worker_position}}': worker.position,
+            '{{worker_license}}': worker.license,
+        })
+    return replacements
+
+
 # Подключаем статические файлы и шаблоны
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
@@ -154,7 +197,8 @@ async def generate_document(
         address: str = Form(...),
         contract_date: str = Form(...),
         contract_type: str = Form(...),
-        template_file: UploadFile = File(...)
+        template_file: UploadFile = File(...),
+        leader_surname: Optional[str] = Form(None)
 ):
     """Генерация документа с заменой плейсхолдеров"""
 
@@ -171,16 +215,22 @@ async def generate_document(
 
         # Обрабатываем документ
         try:
-            processor = WordTemplateProcessor(TEMPLATE_PATH)
+            # шаблон разбирается в потоке, пока ждем ответа БД
+            processor, team_replacements = await asyncio.gather(
+                asyncio.to_thread(WordTemplateProcessor, TEMPLATE_PATH),
+                get_team_replacements(leader_surname)
+            )
+            replacements.update(team_replacements)
             processor.set_replacements(replacements)
             processor.process_document()
 
             # Генерируем имя файла
             output_filename = f"Договор_{company_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.docx"
-            output_path = OUTPUT_DIR / output_filename
-
             # Сохраняем результат
+            output_store.reserve()
+            output_path = output_store.temp_path('.docx')
             processor.doc.save(output_path)
+            output_path = output_store.put(output_path)
 
             # Отправляем файл пользователю
             return FileResponse(
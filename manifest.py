@@ -0,0 +1,91 @@
+"""
+Журнал загруженных файлов по пользователям (SQLite) вместо data/date_manager.txt.
+
+У каждого пользователя (cookie client_id) свой текущий файл каждого вида ('graf' - график ТО),
+сами файлы лежат в FileStore по хэшу. Номера ТО разобранного графика сохраняются по хэшу,
+так что одинаковый файл разбирается один раз для всех пользователей.
+Каждая запись - один оператор UPSERT, поэтому несколько воркеров пишут без своих блокировок;
+чтение в режиме WAL не ждет записи.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+MANIFEST_PATH = os.getenv('MANIFEST_PATH', 'data/manifest.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    client_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    original_name TEXT NOT NULL,
+    object_name TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    uploaded_at REAL NOT NULL,
+    PRIMARY KEY (client_id, kind)
+);
+CREATE INDEX IF NOT EXISTS ix_files_client_name ON files (client_id, original_name);
+CREATE TABLE IF NOT EXISTS parsed (
+    sha256 TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+"""
+
+
+class Manifest:
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = str(path)
+        self._local = threading.local()  # соединение sqlite3 на поток
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        connection = self._connection()
+        connection.executescript(SCHEMA)
+
+    def _connection(self):
+        # соединение открывается в том процессе, где используется (после fork - заново)
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def set_file(self, client_id, kind, original_name, object_name, sha256):
+        """Делает файл текущим файлом вида kind у пользователя"""
+        self._connection().execute(
+            "INSERT INTO files (client_id, kind, original_name, object_name, sha256, uploaded_at) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (client_id, kind) DO UPDATE SET original_name = excluded.original_name, "
+            "object_name = excluded.object_name, sha256 = excluded.sha256, uploaded_at = excluded.uploaded_at",
+            (client_id, kind, original_name, object_name, sha256, time.time()))
+
+    def list_files(self, client_id):
+        """Файлы пользователя: [{'kind', 'original_name', 'object_name', 'sha256', 'uploaded_at'}]"""
+        rows = self._connection().execute(
+            "SELECT kind, original_name, object_name, sha256, uploaded_at FROM files "
+            "WHERE client_id = ? ORDER BY kind", (client_id,))
+        return [dict(row) for row in rows]
+
+    def find_file(self, client_id, original_name):
+        row = self._connection().execute(
+            "SELECT kind, original_name, object_name, sha256, uploaded_at FROM files "
+            "WHERE client_id = ? AND original_name = ?", (client_id, original_name)).fetchone()
+        return dict(row) if row is not None else None
+
+    def remove_file(self, client_id, kind):
+        self._connection().execute("DELETE FROM files WHERE client_id = ? AND kind = ?", (client_id, kind))
+
+    def get_parsed(self, sha256):
+        """Результат разбора файла с таким хэшем или None"""
+        row = self._connection().execute("SELECT data FROM parsed WHERE sha256 = ?", (sha256,)).fetchone()
+        return json.loads(row['data']) if row is not None else None
+
+    def save_parsed(self, sha256, kind, data):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO parsed (sha256, kind, data) VALUES (?, ?, ?)",
+            (sha256, kind, json.dumps(data, ensure_ascii=False)))
@@ -0,0 +1,139 @@
+"""
+Ход генерации отчета по этапам для страницы и операторов (Server-Sent Events).
+
+Страница передает в /generate свой progress_id и одновременно открывает /generate_progress/<progress_id>.
+Этапы пишутся в SQLite, поэтому поток событий читается с любого воркера, а не только с того,
+который собирает документ. Записи старше PROGRESS_TTL удаляются при начале новой генерации.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+PROGRESS_PATH = os.getenv('PROGRESS_PATH', 'data/progress.db')
+PROGRESS_TTL = 3600  # секунды
+PROGRESS_POLL = 0.25  # как часто поток событий проверяет новые этапы, секунды
+PROGRESS_PING = 10  # комментарий-пинг в молчащем потоке, секунды
+PROGRESS_WAIT = int(os.getenv('PROGRESS_WAIT', '300'))  # сколько держать поток событий открытым
+
+PROGRESS_ID_CHARS = set('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    progress_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    elapsed REAL NOT NULL,
+    duration REAL NOT NULL,
+    detail TEXT,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (progress_id, seq)
+);
+CREATE INDEX IF NOT EXISTS ix_events_created ON events (created_at);
+"""
+
+FINAL_STAGES = ('done', 'error')
+
+
+def is_valid_id(progress_id) -> bool:
+    return bool(progress_id) and len(progress_id) <= 64 and set(progress_id) <= PROGRESS_ID_CHARS
+
+
+class Progress:
+    """Этапы одной генерации: время от начала и длительность этапа; без log - только замер времени"""
+
+    def __init__(self, log, progress_id):
+        self.log = log
+        self.progress_id = progress_id
+        self.started = time.monotonic()
+        self.last = self.started
+        self.seq = 0
+
+    def stage(self, stage, detail=None):
+        """Записывает завершенный этап; возвращает его длительность в секундах"""
+        now = time.monotonic()
+        duration = now - self.last
+        self.last = now
+        self.seq += 1
+        if self.log is None:
+            return duration
+        try:
+            self.log.add(self.progress_id, self.seq, stage, now - self.started, duration, detail)
+        except sqlite3.Error as e:  # ход генерации не должен ломать саму генерацию
+            print(f"Не удалось записать этап {stage}: {e}")
+        return duration
+
+    def finish(self, error=None):
+        if error is None:
+            self.stage('done')
+        else:
+            self.stage('error', str(error))
+
+
+class ProgressLog:
+    def __init__(self, path=PROGRESS_PATH):
+        self.path = str(path)
+        self._local = threading.local()  # соединение sqlite3 на поток
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        # соединение открывается в том процессе, где используется (после fork - заново)
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")  # потеря хода генерации при сбое не страшна
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def begin(self, progress_id) -> Progress:
+        connection = self._connection()
+        connection.execute("DELETE FROM events WHERE created_at < ? OR progress_id = ?",
+                           (time.time() - PROGRESS_TTL, progress_id))
+        progress = Progress(self, progress_id)
+        progress.stage('start')
+        return progress
+
+    def add(self, progress_id, seq, stage, elapsed, duration, detail=None):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO events (progress_id, seq, stage, elapsed, duration, detail, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (progress_id, seq, stage, elapsed, duration, detail, time.time()))
+
+    def events(self, progress_id, after_seq=0):
+        """Этапы генерации с номером больше after_seq"""
+        rows = self._connection().execute(
+            "SELECT seq, stage, elapsed, duration, detail FROM events "
+            "WHERE progress_id = ? AND seq > ? ORDER BY seq", (progress_id, after_seq))
+        return [dict(row) for row in rows]
+
+    def stream(self, progress_id, after_seq=0, wait=PROGRESS_WAIT):
+        """
+        Поток событий text/event-stream: по событию на этап, пока генерация не закончится.
+        Если генерация еще не началась, поток ждет ее до wait секунд.
+        after_seq - номер последнего полученного этапа при переподключении (Last-Event-ID)
+        """
+        deadline = time.monotonic() + wait
+        last_seq = after_seq
+        last_sent = time.monotonic()
+        yield "retry: 2000\n\n"
+        while time.monotonic() < deadline:
+            events = self.events(progress_id, last_seq)
+            for event in events:
+                last_seq = event['seq']
+                last_sent = time.monotonic()
+                event['elapsed'] = round(event['elapsed'], 3)
+                event['duration'] = round(event['duration'], 3)
+                yield f"id: {event['seq']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+                if event['stage'] in FINAL_STAGES:
+                    return
+            if time.monotonic() - last_sent > PROGRESS_PING:
+                last_sent = time.monotonic()
+                yield ": ping\n\n"  # прокси не закрывает молчащее соединение, разрыв клиента замечается
+            time.sleep(PROGRESS_POLL)
+        yield "event: timeout\ndata: {}\n\n"
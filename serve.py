@@ -0,0 +1,78 @@
+"""
+Запуск в продакшене: pre-fork сервер gunicorn.
+
+Приложение импортируется и прогревается (шаблон, нормы, БД) в главном процессе до fork,
+поэтому воркеры получают готовые кэши общими страницами памяти и первый запрос не ждет прогрева.
+
+    python serve.py
+
+Настройки через переменные окружения: WEB_BIND, WEB_WORKERS, WEB_THREADS, WEB_TIMEOUT,
+WEB_GRACEFUL_TIMEOUT, WEB_KEEPALIVE, WEB_MAX_REQUESTS. Каждая генерация в работе или в очереди
+занимает два потока (/generate и /generate_progress), поэтому admission.py принимает на воркер
+не больше (WEB_THREADS - 1) // 2 генераций.
+"""
+import multiprocessing
+import os
+import sys
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:  # gunicorn есть только на Linux-сервере
+    BaseApplication = None
+
+
+WEB_BIND = os.getenv('WEB_BIND', '0.0.0.0:8000')
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', str(multiprocessing.cpu_count() * 2 + 1)))
+WEB_THREADS = int(os.getenv('WEB_THREADS', '8'))  # по 2 на генерацию (admission.py) и остальным запросам
+WEB_TIMEOUT = int(os.getenv('WEB_TIMEOUT', '120'))  # генерация большого отчета может идти долго
+WEB_GRACEFUL_TIMEOUT = int(os.getenv('WEB_GRACEFUL_TIMEOUT', '30'))
+WEB_KEEPALIVE = int(os.getenv('WEB_KEEPALIVE', '5'))
+WEB_MAX_REQUESTS = int(os.getenv('WEB_MAX_REQUESTS', '0'))  # перезапуск воркера после N запросов, 0 - нет
+
+
+def post_fork(server, worker):
+    import another_try
+
+    another_try.after_fork()
+
+
+def options():
+    return {
+        'bind': WEB_BIND,
+        'workers': WEB_WORKERS,
+        'threads': WEB_THREADS,
+        'worker_class': 'gthread',
+        'timeout': WEB_TIMEOUT,
+        'graceful_timeout': WEB_GRACEFUL_TIMEOUT,
+        'keepalive': WEB_KEEPALIVE,
+        'max_requests': WEB_MAX_REQUESTS,
+        'max_requests_jitter': WEB_MAX_REQUESTS // 10,
+        'preload_app': True,
+        'post_fork': post_fork,
+    }
+
+
+if BaseApplication is not None:
+    class ProductionServer(BaseApplication):
+        def __init__(self, options=None):
+            self.options = options or {}
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                if key in self.cfg.settings and value is not None:
+                    self.cfg.set(key, value)
+
+        def load(self):
+            # с preload_app вызывается один раз в главном процессе
+            import another_try
+
+            another_try.warm_up()
+            return another_try.app
+
+
+if __name__ == "__main__":
+    if BaseApplication is None:
+        print("gunicorn не установлен: pip install gunicorn (для отладки: python another_try.py)")
+        sys.exit(1)
+    ProductionServer(options()).run()
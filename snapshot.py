@@ -0,0 +1,156 @@
+"""
+Локальный снимок справочных данных (сотрудники, удостоверения, приборы, строки приложений)
+для генерации без обращения к БД.
+
+Снимок - файл SQLite, который открывается только на чтение и читается через mmap,
+поэтому запросы к нему не уходят в сеть и переживают недоступность основной БД.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+from db import Employee, License, Instrument, TeamPrilojenie, normalize_surname
+
+
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', 'data/reference_snapshot.db')
+SNAPSHOT_INTERVAL = int(os.getenv('SNAPSHOT_INTERVAL', '600'))  # секунды между выгрузками
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE employees (
+    id INTEGER PRIMARY KEY, name TEXT, surname TEXT, surname_normalized TEXT, lastname TEXT,
+    team_number INTEGER, position TEXT, license TEXT, license_number TEXT, instrument_table TEXT
+);
+CREATE TABLE licenses (id INTEGER PRIMARY KEY, license_number TEXT, license TEXT, license_end_date TEXT);
+CREATE TABLE instruments (
+    team_number INTEGER, slot INTEGER, kind TEXT, model TEXT, serial TEXT,
+    certificate TEXT, valid_until TEXT, valid_until_raw TEXT
+);
+CREATE TABLE team_prilojenie (team_number INTEGER PRIMARY KEY, layout_key TEXT, data TEXT);
+CREATE INDEX ix_employees_surname_normalized ON employees (surname_normalized);
+CREATE INDEX ix_employees_team_number ON employees (team_number);
+CREATE INDEX ix_licenses_license_number ON licenses (license_number);
+CREATE INDEX ix_instruments_team_number ON instruments (team_number, slot);
+"""
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+def export_snapshot(db, path=SNAPSHOT_PATH):
+    """Выгружает справочные данные из БД в файл снимка (запись во временный файл и атомарная замена)"""
+    session = db.SessionLocal()
+    try:
+        employees = [(e.id, e.name, e.surname, e.surname_normalized, e.lastname, e.team_number, e.position,
+                      e.license, e.license_number, e.instrument_table) for e in session.query(Employee)]
+        licenses = [(l.id, l.license_number, l.license, _isoformat(l.license_end_date))
+                    for l in session.query(License)]
+        instruments = [(i.team_number, i.slot, i.kind, i.model, i.serial, i.certificate,
+                        _isoformat(i.valid_until), i.valid_until_raw) for i in session.query(Instrument)]
+        prilojenie = [(p.team_number, p.layout_key, p.data) for p in session.query(TeamPrilojenie)]
+    finally:
+        session.close()
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    connection = sqlite3.connect(tmp_path)
+    try:
+        connection.executescript(SCHEMA)
+        connection.execute("INSERT INTO meta VALUES ('created_at', ?)", (str(time.time()),))
+        connection.executemany("INSERT INTO employees VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", employees)
+        connection.executemany("INSERT INTO licenses VALUES (?, ?, ?, ?)", licenses)
+        connection.executemany("INSERT INTO instruments VALUES (?, ?, ?, ?, ?, ?, ?, ?)", instruments)
+        connection.executemany("INSERT INTO team_prilojenie VALUES (?, ?, ?)", prilojenie)
+        connection.commit()
+        connection.execute("VACUUM")
+    finally:
+        connection.close()
+    os.replace(tmp_path, path)
+    print(f"Снимок справочных данных сохранен: {path} (сотрудников {len(employees)}, приборов {len(instruments)})")
+
+
+class SnapshotReader:
+    """
+    Чтение снимка с теми же методами, что использует generate_document у DatabaseManager.
+    Файл открывается заново, если его заменила новая выгрузка.
+    """
+
+    def __init__(self, path=SNAPSHOT_PATH):
+        self.path = path
+        self._local = threading.local()  # соединение sqlite3 на поток
+
+    def is_available(self):
+        return os.path.exists(self.path)
+
+    def _connection(self):
+        mtime = os.path.getmtime(self.path)
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.mtime != mtime:
+            if connection is not None:
+                connection.close()
+            connection = sqlite3.connect(f"file:{os.path.abspath(self.path)}?mode=ro", uri=True)
+            connection.row_factory = sqlite3.Row
+            connection.execute(f"PRAGMA mmap_size={256 * 1024 * 1024}")
+            self._local.connection = connection
+            self._local.mtime = mtime
+        return connection
+
+    def age(self):
+        """Возраст снимка в секундах"""
+        row = self._connection().execute("SELECT value FROM meta WHERE key = 'created_at'").fetchone()
+        return time.time() - float(row['value'])
+
+    def get_team_by_leader_surname(self, surname):
+        key = normalize_surname(surname)
+        members = [SimpleNamespace(**dict(row)) for row in self._connection().execute(
+            "SELECT e.* FROM employees e JOIN employees l ON l.team_number = e.team_number "
+            "WHERE l.surname_normalized = ? ORDER BY e.id", (key,))]
+        leader = next((member for member in members if member.surname_normalized == key), None)
+        if leader is None:
+            return None, []
+        return leader, [member for member in members
+                        if member.team_number == leader.team_number and member.id != leader.id]
+
+    def get_team_instruments(self, team_number):
+        instruments = []
+        for row in self._connection().execute(
+                "SELECT * FROM instruments WHERE team_number = ? ORDER BY slot", (team_number,)):
+            instrument = SimpleNamespace(**dict(row))
+            if instrument.valid_until is not None:
+                instrument.valid_until = datetime.fromisoformat(instrument.valid_until)
+            instruments.append(instrument)
+        return instruments
+
+    def get_team_prilojenie(self, team_number, layout_key):
+        row = self._connection().execute(
+            "SELECT layout_key, data FROM team_prilojenie WHERE team_number = ?", (team_number,)).fetchone()
+        if row is None or row['layout_key'] != layout_key:
+            return None
+        return json.loads(row['data'])
+
+    def save_team_prilojenie(self, team_number, layout_key, prilojenie):
+        # снимок только для чтения, строки сохранятся в БД при следующей генерации с ней
+        return False
+
+
+def start_periodic_export(db, path=SNAPSHOT_PATH, interval=SNAPSHOT_INTERVAL):
+    """Фоновая выгрузка снимка каждые interval секунд, пока БД доступна"""
+    def run():
+        while True:
+            if db.is_ready():
+                try:
+                    export_snapshot(db, path)
+                except Exception as e:
+                    print(f"Ошибка выгрузки снимка: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name="snapshot-export", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,116 @@
+"""
+Статика интерфейса: файлы из static/ читаются при старте, для текстовых заранее готовятся
+gzip и brotli варианты. Ссылки на файлы содержат хэш содержимого (?v=...), такие ответы
+кэшируются браузером надолго; ответы без хэша проверяются по ETag.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+
+try:
+    import brotli
+except ImportError:  # без пакета brotli отдается только gzip
+    brotli = None
+
+
+# сжимаются только текстовые форматы: png и woff2 уже сжаты
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.html', '.svg', '.json', '.txt', '.map', '.ttf', '.eot', '.ico'}
+MIN_COMPRESS_SIZE = 512
+
+CACHE_IMMUTABLE = 'public, max-age=31536000, immutable'
+CACHE_REVALIDATE = 'no-cache'
+
+CSS_URL_RE = re.compile(r"url\((['\"]?)([^)'\"?#]+)([^)'\"]*)\1\)")
+
+
+class CompressedBody:
+    """Тело ответа и его сжатые варианты с ETag для каждого"""
+
+    def __init__(self, data: bytes, mimetype: str):
+        self.mimetype = mimetype
+        self.version = hashlib.sha256(data).hexdigest()[:16]
+        self.variants = {'identity': data}
+        extension = mimetypes.guess_extension(mimetype.split(';')[0]) or ''
+        if (extension in COMPRESSIBLE_EXTENSIONS or mimetype.startswith('text/')) and len(data) >= MIN_COMPRESS_SIZE:
+            self.variants['gzip'] = gzip.compress(data, compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.variants['br'] = brotli.compress(data, quality=11)
+
+    def choose(self, accept_encoding) -> str:
+        """Кодировка ответа по Accept-Encoding клиента (werkzeug MIMEAccept/Accept)"""
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accept_encoding[encoding]:
+                return encoding
+        return 'identity'
+
+    def etag(self, encoding: str) -> str:
+        return self.version if encoding == 'identity' else f"{self.version}-{encoding}"
+
+
+class StaticAssets:
+    """Статические файлы каталога в памяти: {путь относительно каталога: CompressedBody}"""
+
+    def __init__(self, static_dir):
+        self.static_dir = str(static_dir)
+        self.assets = {}
+
+    def build(self):
+        assets = {}
+        css_files = []
+        for root, _, files in os.walk(self.static_dir):
+            for file_name in files:
+                full_path = os.path.join(root, file_name)
+                name = os.path.relpath(full_path, self.static_dir).replace(os.sep, '/')
+                if name.endswith('.css'):
+                    css_files.append(name)
+                    continue
+                with open(full_path, 'rb') as f:
+                    assets[name] = CompressedBody(f.read(), self._mimetype(name))
+        # CSS последними: ссылки на шрифты и картинки внутри получают хэш содержимого
+        for name in css_files:
+            with open(os.path.join(self.static_dir, name), 'rb') as f:
+                css = f.read().decode('utf-8')
+            css = CSS_URL_RE.sub(lambda match: self._versioned_css_url(assets, name, match), css)
+            assets[name] = CompressedBody(css.encode('utf-8'), self._mimetype(name))
+        self.assets = assets
+        return self
+
+    def _mimetype(self, name):
+        mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        if mimetype.startswith('text/'):
+            mimetype += '; charset=utf-8'
+        return mimetype
+
+    def _versioned_css_url(self, assets, css_name, match):
+        quote, url, suffix = match.groups()
+        if ':' in url or url.startswith('/'):
+            return match.group(0)
+        target = os.path.normpath(os.path.join(os.path.dirname(css_name), url)).replace(os.sep, '/')
+        asset = assets.get(target)
+        if asset is None or suffix:
+            return match.group(0)
+        return f"url({quote}{url}?v={asset.version}{quote})"
+
+    def get(self, name) -> CompressedBody:
+        return self.assets.get(name)
+
+    def url(self, name) -> str:
+        """URL файла с хэшем содержимого; для неизвестного файла - обычный /static/..."""
+        asset = self.assets.get(name)
+        if asset is None:
+            return f"/static/{name}"
+        return f"/static/{name}?v={asset.version}"
+
+
+def make_response_for(body: CompressedBody, request, response_class, cache_control):
+    """Ответ с выбранным вариантом тела, ETag и Cache-Control; 304 при совпадении ETag"""
+    encoding = body.choose(request.accept_encodings)
+    response = response_class(body.variants[encoding], mimetype=body.mimetype)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = cache_control
+    response.set_etag(body.etag(encoding))
+    return response.make_conditional(request)
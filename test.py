@@ -21,6 +21,11 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs('static', exist_ok=True)
 
+# загруженные шаблоны: одинаковые файлы хранятся один раз, старые удаляются в фоне
+from file_store import FileStore
+upload_store = FileStore(app.config['UPLOAD_FOLDER'])
+upload_store.start_cleaner()
+
 
 class WordTemplateProcessor:
     def __init__(self, template_path: str):
@@ -153,10 +158,9 @@ class WordTemplateProcessor:
 
 def save_template_to_server(file):
     """Сохранение загруженного шаблона"""
-    filename = f"template_{datetime.now().strftime('%Y%m%d_%H%M%S')}.docx"
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    filepath = upload_store.temp_path('.docx')
     file.save(filepath)
-    return filepath
+    return upload_store.put(filepath)
 
 
 @app.route('/', methods=['GET', 'POST'])